@@ -1,10 +1,37 @@
 import unittest
+import unittest.mock
+import copy
 import time
 import tempfile
 import os
 import json
 import logging
+import queue
+import threading
+import subprocess
+import sys
 from varys import Varys
+from varys.blob_store import (
+    CLAIM_CHECK_HEADER,
+    BlobStore,
+    FileBlobStore,
+    claim_check_message,
+    make_claim_check,
+)
+from varys.capture import CaptureWriter, read_capture, replay
+from varys.consumer import Consumer
+from varys.memory import MemoryBroker, get_broker
+from varys.process import _ssl_options_cache, connection_parameters
+from varys.producer import Producer
+from varys.tracing import (
+    HOPS_HEADER,
+    PUBLISHED_AT_HEADER,
+    TRACE_ID_HEADER,
+    TraceHook,
+    read_trace_headers,
+    trace_headers,
+)
+from varys.utils import ConfigurationError, FanIn, load_configuration, varys_message
 import pika
 
 DIR = os.path.dirname(__file__)
@@ -13,6 +40,26 @@ TMP_HANDLE, TMP_FILENAME = tempfile.mkstemp()
 TEXT = "Hello, world!"
 
 
+def varys_handlers(logger):
+    # pytest's log capture attaches a handler to every non-propagating logger that exists when a test starts,
+    # which is the case for exchange loggers set up by an earlier test in the same process
+    return [h for h in logger.handlers if type(h).__name__ != "LogCaptureHandler"]
+
+
+class RecordingTraceHook(TraceHook):
+    def __init__(self):
+        self.calls = []
+
+    def on_publish(self, exchange, trace_id, hops):
+        self.calls.append(("on_publish", exchange, trace_id, hops))
+
+    def on_deliver(self, exchange, trace_id, hops, enqueue_to_deliver):
+        self.calls.append(("on_deliver", exchange, trace_id, hops, enqueue_to_deliver))
+
+    def on_dequeue(self, exchange, trace_id, hops, deliver_to_dequeue):
+        self.calls.append(("on_dequeue", exchange, trace_id, hops, deliver_to_dequeue))
+
+
 class TestVarys(unittest.TestCase):
 
     def tearDown(self):
@@ -35,12 +82,13 @@ class TestVarys(unittest.TestCase):
         channel = connection.channel()
 
         channel.queue_delete(queue="test_varys.q")
+        channel.queue_delete(queue="test_varys_2.q")
 
         connection.close()
 
         # check that all file handles were dropped
         logger = logging.getLogger("test_varys")
-        self.assertEqual(len(logger.handlers), 0)
+        self.assertEqual(len(varys_handlers(logger)), 0)
 
     def send_and_receive(self):
         self.v.send(TEXT, "test_varys", queue_suffix="q")
@@ -48,7 +96,7 @@ class TestVarys(unittest.TestCase):
         self.assertEqual(TEXT, json.loads(message.body))
 
         logger = logging.getLogger("test_varys")
-        self.assertEqual(len(logger.handlers), 1)
+        self.assertEqual(len(varys_handlers(logger)), 1)
 
     def manual_ack(self):
 
@@ -84,6 +132,92 @@ class TestVarys(unittest.TestCase):
         parsed_messages = [json.loads(m.body) for m in messages]
         self.assertListEqual([TEXT, TEXT], parsed_messages)
 
+    def stream(self):
+        for _ in range(3):
+            self.v.send(TEXT, "test_varys", queue_suffix="q")
+
+        messages = list(self.v.stream("test_varys", queue_suffix="q", idle_timeout=1))
+        self.assertListEqual([TEXT] * 3, [json.loads(m.body) for m in messages])
+
+    def stream_chunks(self):
+        # start consuming first so all the messages have been prefetched when the stream begins
+        self.assertIsNone(self.v.receive("test_varys", queue_suffix="q", timeout=0))
+
+        for _ in range(3):
+            self.v.send(TEXT, "test_varys", queue_suffix="q")
+        time.sleep(0.5)
+
+        chunks = list(
+            self.v.stream("test_varys", queue_suffix="q", chunk_size=2, idle_timeout=1)
+        )
+        self.assertListEqual([2, 1], [len(chunk) for chunk in chunks])
+
+    def trace(self):
+        hook = RecordingTraceHook()
+        self.v.trace_hook = hook
+
+        self.v.send(TEXT, "test_varys", queue_suffix="q")
+        message = self.v.receive("test_varys", queue_suffix="q")
+        self.assertEqual(TEXT, json.loads(message.body))
+
+        trace_id, _, hops = read_trace_headers(message.properties)
+        self.assertEqual(0, hops)
+        self.assertEqual(
+            ["on_publish", "on_deliver", "on_dequeue"], [call[0] for call in hook.calls]
+        )
+        self.assertTrue(all(call[2] == trace_id for call in hook.calls))
+
+    def receive_any(self):
+        # start consuming from both exchanges before anything is sent
+        self.assertIsNone(
+            self.v.receive_any(["test_varys", "test_varys_2"], queue_suffix="q", timeout=0)
+        )
+        self.assertListEqual([], self.v.select(["test_varys", "test_varys_2"], timeout=0))
+
+        self.v.send(TEXT, "test_varys_2", queue_suffix="q")
+
+        self.assertListEqual(["test_varys_2"], self.v.select(["test_varys", "test_varys_2"], timeout=5))
+        message = self.v.receive_any(["test_varys", "test_varys_2"], timeout=5)
+        self.assertEqual("test_varys_2", message.basic_deliver.exchange)
+        self.assertEqual(TEXT, json.loads(message.body))
+
+    def claim_check(self):
+        blob_dir = tempfile.mkdtemp()
+        self.v.blob_store = FileBlobStore(blob_dir, delete_after_ack=True)
+        self.v.claim_check_threshold = 100
+
+        large = "x" * 1000
+        self.v.send(large, "test_varys", queue_suffix="q")
+        self.v.send(TEXT, "test_varys", queue_suffix="q")
+
+        message = self.v.receive("test_varys", queue_suffix="q")
+        self.assertIsInstance(message, claim_check_message)
+        self.assertEqual(large, json.loads(message.body))
+
+        message = self.v.receive("test_varys", queue_suffix="q")
+        self.assertNotIsInstance(message, claim_check_message)
+        self.assertEqual(TEXT, json.loads(message.body))
+
+        # the offloaded body was deleted once acked and read
+        self.assertListEqual([], os.listdir(blob_dir))
+        os.rmdir(blob_dir)
+
+    def close_report(self):
+        for _ in range(3):
+            self.v.send(TEXT, "test_varys", queue_suffix="q")
+
+        self.v.receive("test_varys", queue_suffix="q")
+        time.sleep(0.5)
+
+        start = time.monotonic()
+        report = self.v.close(timeout=5)
+        self.assertLess(time.monotonic() - start, 5)
+
+        # the two prefetched messages that were never received are handed back
+        self.assertEqual(2, len(report["requeued"]["test_varys"]))
+        self.assertDictEqual({}, report["undelivered"])
+        self.assertListEqual([], report["timed_out"])
+
     def receive_no_message(self):
         self.assertIsNone(
             self.v.receive("test_varys", queue_suffix="q", timeout=0)
@@ -133,6 +267,24 @@ class TestVarysTLS(TestVarys):
     def test_send_and_receive_batch(self):
         self.send_and_receive_batch()
 
+    def test_stream(self):
+        self.stream()
+
+    def test_stream_chunks(self):
+        self.stream_chunks()
+
+    def test_trace(self):
+        self.trace()
+
+    def test_receive_any(self):
+        self.receive_any()
+
+    def test_claim_check(self):
+        self.claim_check()
+
+    def test_close_report(self):
+        self.close_report()
+
     def test_receive_no_message(self):
         self.receive_no_message()
 
@@ -180,6 +332,80 @@ class TestVarysNoTLS(TestVarys):
     def test_send_and_receive_batch(self):
         self.send_and_receive_batch()
 
+    def test_stream(self):
+        self.stream()
+
+    def test_stream_chunks(self):
+        self.stream_chunks()
+
+    def test_trace(self):
+        self.trace()
+
+    def test_receive_any(self):
+        self.receive_any()
+
+    def test_claim_check(self):
+        self.claim_check()
+
+    def test_close_report(self):
+        self.close_report()
+
+    def test_receive_no_message(self):
+        self.receive_no_message()
+
+    def test_send_no_suffix(self):
+        self.send_no_suffix()
+
+    def test_receive_no_suffix(self):
+        self.receive_no_suffix()
+
+    def test_receive_batch_no_suffix(self):
+        self.receive_batch_no_suffix()
+
+
+class TestVarysMemory(TestVarys):
+
+    def setUp(self):
+        self.v = Varys("test", LOG_FILENAME, transport="memory")
+
+    def tearDown(self):
+        self.v.close()
+        get_broker().reset()
+
+        # check that all file handles were dropped
+        logger = logging.getLogger("test_varys")
+        self.assertEqual(len(varys_handlers(logger)), 0)
+
+    def test_send_and_receive(self):
+        self.send_and_receive()
+
+    def test_manual_ack(self):
+        self.manual_ack()
+
+    def test_nack(self):
+        self.nack()
+
+    def test_send_and_receive_batch(self):
+        self.send_and_receive_batch()
+
+    def test_stream(self):
+        self.stream()
+
+    def test_stream_chunks(self):
+        self.stream_chunks()
+
+    def test_trace(self):
+        self.trace()
+
+    def test_receive_any(self):
+        self.receive_any()
+
+    def test_claim_check(self):
+        self.claim_check()
+
+    def test_close_report(self):
+        self.close_report()
+
     def test_receive_no_message(self):
         self.receive_no_message()
 
@@ -192,6 +418,40 @@ class TestVarysNoTLS(TestVarys):
     def test_receive_batch_no_suffix(self):
         self.receive_batch_no_suffix()
 
+    def test_claim_check_unread(self):
+        blob_dir = tempfile.mkdtemp()
+        self.v.blob_store = FileBlobStore(blob_dir, delete_after_ack=True)
+        self.v.claim_check_threshold = 100
+
+        self.v.send("x" * 1000, "test_varys", queue_suffix="q")
+        message = self.v.receive("test_varys", queue_suffix="q", timeout=1)
+        self.assertIsInstance(message, claim_check_message)
+        self.assertEqual(1, len(os.listdir(blob_dir)))
+
+        # acked on receipt, so dropping the message without reading it deletes the body
+        del message
+        self.assertEqual([], os.listdir(blob_dir))
+        os.rmdir(blob_dir)
+
+    def test_failed_start(self):
+        # the memory transport has no headers exchanges, so the producer and consumer fail to start
+        self.assertRaises(
+            ValueError, self.v.send, TEXT, "test_varys_headers", queue_suffix="q", exchange_type="headers"
+        )
+        self.assertRaises(
+            ValueError, self.v.receive, "test_varys_headers", queue_suffix="q", exchange_type="headers"
+        )
+
+        # processes which never started aren't kept, so closing doesn't wait on them
+        channels = self.v.get_channels()
+        self.assertEqual([], list(channels["consumer_channels"]))
+        self.assertEqual([], list(channels["producer_channels"]))
+        report = self.v.close(timeout=1)
+        self.assertEqual([], report["timed_out"])
+
+        logger = logging.getLogger("test_varys_headers")
+        self.assertEqual(len(varys_handlers(logger)), 0)
+
 
 class TestVarysConfig(unittest.TestCase):
     def tearDown(self):
@@ -201,11 +461,11 @@ class TestVarysConfig(unittest.TestCase):
         with open(TMP_FILENAME, "w") as f:
             f.write("asdf9υ021ζ3;-ö×=()[]{}∇Δοo")
 
-        # use a context manager so we can check SystemExit code
-        with self.assertRaises(SystemExit) as cm:
+        # use a context manager so we can check the exit code
+        with self.assertRaises(ConfigurationError) as cm:
             v = Varys("test", LOG_FILENAME, config_path=TMP_FILENAME)
 
-        self.assertEqual(cm.exception.code, 11)
+        self.assertEqual(cm.exception.exit_code, 11)
 
     def test_config_profile_missing(self):
         config = {
@@ -216,10 +476,10 @@ class TestVarysConfig(unittest.TestCase):
         with open(TMP_FILENAME, "w") as f:
             json.dump(config, f, ensure_ascii=False)
 
-        with self.assertRaises(SystemExit) as cm:
+        with self.assertRaises(ConfigurationError) as cm:
             v = Varys("test", LOG_FILENAME, config_path=TMP_FILENAME)
 
-        self.assertEqual(cm.exception.code, 2)
+        self.assertEqual(cm.exception.exit_code, 2)
 
     def test_config_profile_incomplete(self):
         config = {
@@ -235,10 +495,632 @@ class TestVarysConfig(unittest.TestCase):
         with open(TMP_FILENAME, "w") as f:
             json.dump(config, f, ensure_ascii=False)
 
-        with self.assertRaises(SystemExit) as cm:
+        with self.assertRaises(ConfigurationError) as cm:
             v = Varys("test", LOG_FILENAME, config_path=TMP_FILENAME)
 
-        self.assertEqual(cm.exception.code, 11)
+        self.assertEqual(cm.exception.exit_code, 11)
+
+    def test_config_cached(self):
+        config = {
+            "version": "0.1",
+            "profiles": {
+                "test": {
+                    "username": "guest",
+                    "password": "guest",
+                    "amqp_url": "127.0.0.1",
+                    "port": 5671,
+                    "use_tls": True,
+                }
+            },
+        }
+
+        with open(TMP_FILENAME, "w") as f:
+            json.dump(config, f, ensure_ascii=False)
+
+        first = load_configuration("test", TMP_FILENAME)
+        self.assertIs(first, load_configuration("test", TMP_FILENAME))
+
+        # pika modifies the parameters while connecting, so only the SSL options are shared
+        parameters = connection_parameters(first)
+        self.assertIsNot(parameters, connection_parameters(first))
+        self.assertIs(parameters.ssl_options, connection_parameters(first).ssl_options)
+
+        # modifying the file invalidates the cached profile
+        config["profiles"]["test"]["username"] = "other"
+        with open(TMP_FILENAME, "w") as f:
+            json.dump(config, f, ensure_ascii=False)
+        stat = os.stat(TMP_FILENAME)
+        os.utime(TMP_FILENAME, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+
+        second = load_configuration("test", TMP_FILENAME)
+        self.assertIsNot(first, second)
+        self.assertEqual("other", second.username)
+
+        # only the SSL options for the current version of the file are kept
+        connection_parameters(second)
+        self.assertEqual(
+            1,
+            len([key for key in _ssl_options_cache if key[0] == second.cache_key[0]]),
+        )
+
+        # a rewrite which keeps the old mtime is still noticed, as the size has changed
+        stat = os.stat(TMP_FILENAME)
+        config["profiles"]["test"]["username"] = "another"
+        with open(TMP_FILENAME, "w") as f:
+            json.dump(config, f, ensure_ascii=False)
+        os.utime(TMP_FILENAME, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        third = load_configuration("test", TMP_FILENAME)
+        self.assertIsNot(second, third)
+        self.assertEqual("another", third.username)
+
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        self.varys_client = Varys("test", LOG_FILENAME, transport="memory")
+
+    def tearDown(self):
+        self.varys_client.close()
+        get_broker().reset()
+
+    def make_message(self, body, routing_key="arbitrary_string", headers=None):
+        return varys_message(
+            pika.spec.Basic.Deliver(
+                delivery_tag=1, exchange="test_varys", routing_key=routing_key
+            ),
+            pika.BasicProperties(content_type="json", headers=headers),
+            body,
+        )
+
+    def record_and_replay(self, messages, suffix=".jsonl", batch_size=100):
+        capture_dir = tempfile.mkdtemp()
+        capture_path = os.path.join(capture_dir, "capture" + suffix)
+
+        with CaptureWriter(capture_path) as writer:
+            for received_at, message in enumerate(messages):
+                writer.write(message, received_at=float(received_at))
+
+        records = list(read_capture(capture_path))
+
+        # bind the replay queue before replaying, so nothing goes unrouted
+        self.varys_client.receive(
+            "test_replay", queue_suffix="q", timeout=0
+        )
+        self.assertEqual(
+            len(messages),
+            replay(
+                self.varys_client,
+                "test_replay",
+                capture_path,
+                queue_suffix="q",
+                speed=0,
+                batch_size=batch_size,
+            ),
+        )
+        replayed = [
+            self.varys_client.receive(
+                "test_replay", queue_suffix="q", timeout=1
+            )
+            for _ in messages
+        ]
+
+        os.remove(capture_path)
+        os.rmdir(capture_dir)
+
+        return records, replayed
+
+    def round_trip(self, suffix):
+        message = self.make_message(json.dumps(TEXT).encode("utf-8"), headers={"foo": "bar"})
+        records, replayed = self.record_and_replay([message, message], suffix)
+
+        self.assertEqual([0.0, 1.0], [r["received_at"] for r in records])
+        self.assertEqual("test_varys", records[0]["exchange"])
+        self.assertEqual({"foo": "bar"}, records[0]["properties"]["headers"])
+        self.assertEqual(TEXT, json.loads(records[0]["body"]))
+
+        self.assertEqual(2, len(replayed))
+        for replayed_message in replayed:
+            self.assertEqual(TEXT, json.loads(replayed_message.body))
+            self.assertEqual("bar", replayed_message.properties.headers["foo"])
+            self.assertEqual("json", replayed_message.properties.content_type)
+
+    def test_round_trip_jsonl(self):
+        self.round_trip(".jsonl")
+
+    def test_round_trip_gzip(self):
+        self.round_trip(".jsonl.gz")
+
+    def test_round_trip_binary_body(self):
+        body = b"\xff\x00\xfe binary"
+        records, replayed = self.record_and_replay([self.make_message(body)])
+
+        self.assertEqual("base64", records[0]["body_encoding"])
+        self.assertEqual(body, replayed[0].body)
+
+    def test_round_trip_non_json_body(self):
+        records, replayed = self.record_and_replay([self.make_message(b"not json")])
+
+        self.assertNotIn("body_encoding", records[0])
+        self.assertEqual(b"not json", replayed[0].body)
+
+    def test_replay_keeps_routing_key(self):
+        messages = [
+            self.make_message(b"1", routing_key="sample.new"),
+            self.make_message(b"2", routing_key="sample.updated"),
+        ]
+        records, replayed = self.record_and_replay(messages)
+
+        self.assertEqual(
+            ["sample.new", "sample.updated"],
+            [message.basic_deliver.routing_key for message in replayed],
+        )
+
+    def interrupted_capture(self, suffix):
+        capture_dir = tempfile.mkdtemp()
+        capture_path = os.path.join(capture_dir, "capture" + suffix)
+
+        # kill the writer without closing the capture
+        script = f"""
+import os
+import pika
+from varys.capture import CaptureWriter
+from varys.utils import varys_message
+
+writer = CaptureWriter({capture_path!r})
+for i in range(5):
+    writer.write(varys_message(pika.spec.Basic.Deliver(exchange="test_varys"), None, b"{{}}"))
+os._exit(1)
+"""
+        result = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(DIR))
+        self.assertEqual(1, result.returncode)
+
+        if not suffix.endswith(".gz"):
+            # as if killed part way through writing a record
+            with open(capture_path, "ab") as f:
+                f.write(b'{"received_at"')
+
+        self.assertEqual(5, len(list(read_capture(capture_path))))
+
+        os.remove(capture_path)
+        os.rmdir(capture_dir)
+
+    def test_interrupted_capture_jsonl(self):
+        self.interrupted_capture(".jsonl")
+
+    def test_interrupted_capture_gzip(self):
+        self.interrupted_capture(".jsonl.gz")
+
+    def test_record_claim_checks(self):
+        blob_dir = tempfile.mkdtemp()
+        blob_store = FileBlobStore(blob_dir)
+        body = make_claim_check(blob_store, b"offloaded")
+        headers = {CLAIM_CHECK_HEADER: 1}
+
+        # a recorder without a blob store receives the claim check as a plain message
+        plain = self.make_message(body.encode("utf-8"), headers=headers)
+        claim_checked = claim_check_message(plain.basic_deliver, plain.properties, body, blob_store)
+        records, replayed = self.record_and_replay([plain, claim_checked])
+
+        self.assertEqual([body, body], [record["body"] for record in records])
+        self.assertEqual([body.encode("utf-8")] * 2, [message.body for message in replayed])
+
+        os.remove(os.path.join(blob_dir, claim_checked.claim_check["reference"]))
+        os.rmdir(blob_dir)
+
+    def test_replay_batches(self):
+        messages = [self.make_message(str(i).encode("utf-8")) for i in range(5)]
+
+        producer_class = self.varys_client._producer_class
+        with unittest.mock.patch.object(
+            producer_class, "publish_batch", autospec=True, side_effect=producer_class.publish_batch
+        ) as publish_batch:
+            records, replayed = self.record_and_replay(messages, batch_size=2)
+
+        self.assertEqual([2, 2, 1], [len(call.args[1]) for call in publish_batch.call_args_list])
+        self.assertEqual([b"0", b"1", b"2", b"3", b"4"], [message.body for message in replayed])
+
+    def test_replay_negative_speed(self):
+        self.assertRaises(
+            ValueError, replay, self.varys_client, "test_replay", "capture.jsonl", speed=-1
+        )
+
+
+class TestFanIn(unittest.TestCase):
+    def test_get_in_arrival_order(self):
+        fan_in = FanIn()
+        queue_1, queue_2 = queue.Queue(), queue.Queue()
+
+        fan_in.put("exchange_1", queue_1, "a")
+        fan_in.put("exchange_2", queue_2, "b")
+        fan_in.put("exchange_1", queue_1, "c")
+
+        self.assertEqual(["exchange_1", "exchange_2"], fan_in.ready(["exchange_1", "exchange_2"], timeout=0))
+        self.assertEqual(("exchange_1", "a"), fan_in.get(["exchange_1", "exchange_2"], timeout=0))
+        self.assertEqual(("exchange_2", "b"), fan_in.get(["exchange_1", "exchange_2"], timeout=0))
+        self.assertEqual(("exchange_1", "c"), fan_in.get(["exchange_1", "exchange_2"], timeout=0))
+        self.assertIsNone(fan_in.get(["exchange_1", "exchange_2"], timeout=0))
+
+    def test_get_only_requested_exchanges(self):
+        fan_in = FanIn()
+        queue_1 = queue.Queue()
+
+        fan_in.put("exchange_1", queue_1, "a")
+        self.assertIsNone(fan_in.get(["exchange_2"], timeout=0))
+        self.assertEqual([], fan_in.ready(["exchange_2"], timeout=0))
+
+        # a message taken directly from the consumer's queue is not returned again
+        queue_1.get_nowait()
+        self.assertIsNone(fan_in.get(["exchange_1"], timeout=0))
+
+    def test_stale_exchanges_dropped(self):
+        fan_in = FanIn()
+        queue_1, queue_2 = queue.Queue(), queue.Queue()
+
+        fan_in.put("exchange_1", queue_1, "a")
+        fan_in.put("exchange_2", queue_2, "b")
+        queue_1.get_nowait()
+
+        # the exchange emptied by a plain receive is skipped and forgotten on the way
+        self.assertEqual(("exchange_2", "b"), fan_in.get(["exchange_1", "exchange_2"], timeout=0))
+        self.assertEqual([], list(fan_in._ready))
+
+    def test_get_waits_for_message(self):
+        fan_in = FanIn()
+        message_queue = queue.Queue()
+
+        timer = threading.Timer(0.1, fan_in.put, ("exchange_1", message_queue, "a"))
+        timer.start()
+        self.assertEqual(("exchange_1", "a"), fan_in.get(["exchange_1"], timeout=5))
+        timer.join()
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.blob_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.blob_dir):
+            os.remove(os.path.join(self.blob_dir, name))
+        os.rmdir(self.blob_dir)
+
+    def make_message(self, blob_store, data):
+        return claim_check_message(
+            pika.spec.Basic.Deliver(delivery_tag=1, exchange="test_varys"),
+            pika.BasicProperties(headers={CLAIM_CHECK_HEADER: 1}),
+            make_claim_check(blob_store, data),
+            blob_store,
+        )
+
+    def test_lazy_body(self):
+        blob_store = FileBlobStore(self.blob_dir)
+        data = json.dumps(TEXT).encode("utf-8")
+        message = self.make_message(blob_store, data)
+
+        self.assertEqual(len(data), message.claim_check["size"])
+        self.assertEqual(data, message.body)
+        # bodies are kept unless delete_after_ack is set
+        self.assertEqual(1, len(os.listdir(self.blob_dir)))
+
+    def test_behaves_like_varys_message(self):
+        blob_store = FileBlobStore(self.blob_dir)
+        message = self.make_message(blob_store, b"data")
+
+        basic_deliver, properties, body = message
+        self.assertEqual(b"data", body)
+        self.assertEqual(b"data", message[2])
+        self.assertEqual(b"data", message[-1])
+        self.assertEqual((properties, b"data"), message[1:])
+        self.assertEqual(b"data", message._asdict()["body"])
+
+        replaced = message._replace(properties=None)
+        self.assertIs(varys_message, type(replaced))
+        self.assertEqual((basic_deliver, None, b"data"), replaced)
+
+        made = claim_check_message._make((basic_deliver, properties, b"other"))
+        self.assertIs(varys_message, type(made))
+        self.assertEqual(b"other", made.body)
+
+        self.assertEqual(b"data", copy.copy(message).body)
+
+    def test_checksum_mismatch(self):
+        blob_store = FileBlobStore(self.blob_dir)
+        message = self.make_message(blob_store, b"original")
+
+        with open(os.path.join(self.blob_dir, message.claim_check["reference"]), "wb") as f:
+            f.write(b"tampered")
+
+        with self.assertRaises(ValueError):
+            message.body
+
+    def test_delete_after_ack(self):
+        blob_store = FileBlobStore(self.blob_dir, delete_after_ack=True)
+        message = self.make_message(blob_store, b"data")
+        reference = message.claim_check["reference"]
+
+        # held by the consumer until acked, as well as by the message until read
+        blob_store.acquire(reference)
+        blob_store.release(reference, settled=True)
+        self.assertEqual(1, len(os.listdir(self.blob_dir)))
+
+        self.assertEqual(b"data", message.body)
+        self.assertEqual([], os.listdir(self.blob_dir))
+
+    def test_delete_after_ack_unread(self):
+        blob_store = FileBlobStore(self.blob_dir, delete_after_ack=True)
+        message = self.make_message(blob_store, b"data")
+        reference = message.claim_check["reference"]
+
+        blob_store.acquire(reference)
+        blob_store.release(reference, settled=True)
+
+        # a message which is never read lets go of its body once it is garbage collected
+        del message
+        self.assertEqual([], os.listdir(self.blob_dir))
+        self.assertEqual({}, dict(blob_store._references))
+        self.assertEqual(set(), blob_store._settled)
+
+    def test_invalid_reference(self):
+        blob_store = FileBlobStore(self.blob_dir)
+        self.assertRaises(ValueError, blob_store.read, "../etc/passwd")
+
+    def test_incomplete_blob_store(self):
+        class PutOnlyBlobStore(BlobStore):
+            def put(self, data):
+                return "reference"
+
+        self.assertRaises(TypeError, PutOnlyBlobStore)
+
+
+class TestMemoryBroker(unittest.TestCase):
+    def setUp(self):
+        self.broker = MemoryBroker()
+
+    def routed(self, exchange_type, binding_key, routing_key):
+        self.broker.declare_exchange("exchange", exchange_type)
+        self.broker.declare_queue("queue")
+        self.broker.bind_queue("queue", "exchange", binding_key)
+        return self.broker.publish("exchange", routing_key, None, b"{}")
+
+    def test_fanout(self):
+        self.assertEqual(1, self.routed("fanout", "a", "b"))
+
+    def test_direct(self):
+        self.assertEqual(1, self.routed("direct", "a.b", "a.b"))
+        self.assertEqual(0, self.broker.publish("exchange", "a.c", None, b"{}"))
+
+    def test_topic(self):
+        self.assertEqual(1, self.routed("topic", "a.*.c", "a.b.c"))
+        self.assertEqual(0, self.broker.publish("exchange", "a.b.b.c", None, b"{}"))
+
+        self.broker.bind_queue("queue", "exchange", "a.#")
+        self.assertEqual(1, self.broker.publish("exchange", "a", None, b"{}"))
+        self.assertEqual(1, self.broker.publish("exchange", "a.b.b.c", None, b"{}"))
+        self.assertEqual(3, len(self.broker.queues["queue"]))
+
+    def test_exchange_type_mismatch(self):
+        self.broker.declare_exchange("exchange", "fanout")
+        self.assertRaises(ValueError, self.broker.declare_exchange, "exchange", "topic")
+        self.assertRaises(ValueError, self.broker.declare_exchange, "other", "headers")
+
+    def test_prefetch_and_redelivery(self):
+        v = Varys("test", LOG_FILENAME, transport="memory", auto_acknowledge=False)
+        try:
+            for i in range(3):
+                v.send(i, "test_varys_prefetch", queue_suffix="q")
+
+            v._get_consumer("test_varys_prefetch", "q", "fanout", prefetch_count=2)
+            first = v.receive("test_varys_prefetch", timeout=1)
+            v.receive("test_varys_prefetch", timeout=1)
+            # the third message is held back until one of the first two is settled
+            self.assertIsNone(v.receive("test_varys_prefetch", timeout=0.1))
+
+            v.nack_message(first)
+            redelivered = v.receive("test_varys_prefetch", timeout=1)
+            self.assertEqual(0, json.loads(redelivered.body))
+            self.assertTrue(redelivered.basic_deliver.redelivered)
+        finally:
+            v.close()
+            get_broker().reset()
+
+    def test_close_requeues_in_order(self):
+        v = Varys("test", LOG_FILENAME, transport="memory")
+        try:
+            for i in range(3):
+                v.send(i, "test_varys_close", queue_suffix="q")
+            v._get_consumer("test_varys_close", "q", "fanout")
+            time.sleep(0.1)
+        finally:
+            report = v.close(timeout=1)
+
+        self.assertEqual(3, len(report["requeued"]["test_varys_close"]))
+
+        v = Varys("test", LOG_FILENAME, transport="memory")
+        try:
+            messages = v.receive_batch("test_varys_close", queue_suffix="q", timeout=0.1)
+            self.assertListEqual([0, 1, 2], [json.loads(m.body) for m in messages])
+            self.assertTrue(all(m.basic_deliver.redelivered for m in messages))
+        finally:
+            v.close()
+            get_broker().reset()
+
+
+class TestProducer(unittest.TestCase):
+    def setUp(self):
+        self.producer = Producer(
+            queue.Queue(), "test_varys_pending", None, LOG_FILENAME, "DEBUG", "q", "fanout"
+        )
+        self.producer._channel = unittest.mock.Mock()
+        self.producer._pending[0] = ("{}", None, "arbitrary_string")
+
+    def tearDown(self):
+        self.producer._stop_logger()
+
+    def test_publish_pending_once(self):
+        self.producer._publish_pending(0, "{}", None, "arbitrary_string")
+        self.producer._publish_pending(0, "{}", None, "arbitrary_string")
+
+        self.assertEqual(1, self.producer._channel.basic_publish.call_count)
+        self.assertEqual({}, self.producer._pending)
+
+    def test_publish_pending_in_flight(self):
+        # the resend after reconnecting can run while the original publish is waiting for its confirm
+        self.producer._channel.basic_publish.side_effect = (
+            lambda *args, **kwargs: self.producer._publish_pending(0, "{}", None, "arbitrary_string")
+        )
+        self.producer._publish_pending(0, "{}", None, "arbitrary_string")
+
+        self.assertEqual(1, self.producer._channel.basic_publish.call_count)
+
+    def test_publish_pending_connection_lost(self):
+        self.producer._channel.basic_publish.side_effect = pika.exceptions.StreamLostError
+        self.assertRaises(
+            pika.exceptions.StreamLostError,
+            self.producer._publish_pending, 0, "{}", None, "arbitrary_string",
+        )
+
+        # still pending, so it is resent once reconnected
+        self.assertIn(0, self.producer._pending)
+        self.assertEqual(set(), self.producer._in_flight)
+
+    def test_resend_skips_unpublishable(self):
+        def basic_publish(exchange, routing_key, body, properties, mandatory):
+            if properties is not None and isinstance(properties.headers.get("sent_at"), float):
+                raise pika.exceptions.UnsupportedAMQPFieldException(None, 1.5)
+
+        self.producer._channel.basic_publish.side_effect = basic_publish
+        self.producer._pending[0] = ("bad", pika.BasicProperties(headers={"sent_at": 1.5}), "a")
+        for publish_id in range(1, 4):
+            self.producer._pending[publish_id] = ("{}", None, "a")
+
+        connections = []
+
+        def connect(parameters):
+            connection = unittest.mock.Mock()
+            connection.channel.return_value = self.producer._channel
+            # stop once connected, so run only makes one pass
+            connection.process_data_events.side_effect = (
+                lambda time_limit: self.producer._request_stop(True, None)
+            )
+            connections.append(connection)
+            return connection
+
+        # run releases the logger when it stops, so take another reference for tearDown
+        self.producer._setup_logger("DEBUG")
+        with unittest.mock.patch("pika.BlockingConnection", side_effect=connect):
+            self.producer.run()
+
+        # the message pika can't encode doesn't hold up the ones behind it
+        self.assertEqual(1, len(connections))
+        self.assertEqual(4, self.producer._channel.basic_publish.call_count)
+        self.assertEqual({}, self.producer._pending)
+        self.assertEqual(["bad"], self.producer._undelivered)
+        connections[0].close.assert_called_once()
+
+
+class TestProducerBatch(unittest.TestCase):
+    def setUp(self):
+        self.producer = Producer(
+            queue.Queue(), "test_varys_batch", None, LOG_FILENAME, "DEBUG", "q", "fanout"
+        )
+        self.producer._connection = unittest.mock.Mock()
+        self.batch_channel = self.producer._connection.channel.return_value
+
+        def add_callback_threadsafe(callback):
+            callback()
+
+        self.producer._connection.add_callback_threadsafe.side_effect = add_callback_threadsafe
+
+    def tearDown(self):
+        self.producer._stop_logger()
+
+    def test_publish_batch(self):
+        def basic_publish(exchange, routing_key, body, properties, mandatory):
+            if body == "bad":
+                raise pika.exceptions.UnsupportedAMQPFieldException(None, 1.5)
+
+        self.batch_channel.basic_publish.side_effect = basic_publish
+        self.producer.publish_batch([("1", None, None), ("bad", "a", None), (b"3", "b", None)])
+
+        # one transaction for the whole batch
+        self.batch_channel.tx_select.assert_called_once()
+        self.batch_channel.tx_commit.assert_called_once()
+        self.assertEqual(3, self.batch_channel.basic_publish.call_count)
+        self.assertEqual(
+            ["arbitrary_string", "a", "b"],
+            [call.args[1] for call in self.batch_channel.basic_publish.call_args_list],
+        )
+        self.assertEqual({}, self.producer._pending)
+        self.assertEqual(["bad"], self.producer._undelivered)
+
+        # the channel is reused for the next batch
+        self.producer.publish_batch([("4", None, None)])
+        self.batch_channel.tx_select.assert_called_once()
+        self.assertEqual(2, self.batch_channel.tx_commit.call_count)
+
+    def test_publish_batch_connection_lost(self):
+        self.batch_channel.tx_commit.side_effect = pika.exceptions.StreamLostError
+        self.assertRaises(
+            pika.exceptions.StreamLostError,
+            self.producer.publish_batch, [("1", None, None), ("2", None, None)],
+        )
+
+        # nothing was committed, so it is all resent once reconnected
+        self.assertEqual(2, len(self.producer._pending))
+        self.assertEqual(set(), self.producer._in_flight)
+
+
+class TestConsumer(unittest.TestCase):
+    def setUp(self):
+        self.consumer = Consumer(
+            queue.Queue(), "test_varys_shutdown", None, LOG_FILENAME, "DEBUG", "q", "fanout"
+        )
+        self.consumer._connection = unittest.mock.Mock()
+        self.consumer._channel = unittest.mock.Mock()
+        self.consumer._message_queue.put(
+            varys_message(pika.spec.Basic.Deliver(delivery_tag=1), None, b"{}")
+        )
+
+    def tearDown(self):
+        self.consumer._stop_logger()
+
+    def test_shutdown_drains(self):
+        self.consumer._request_stop(True, time.monotonic() + 10)
+        self.consumer._shutdown("tag")
+
+        self.consumer._channel.basic_cancel.assert_called_once_with("tag")
+        self.assertEqual(1, self.consumer._channel.basic_nack.call_count)
+        self.assertEqual(1, len(self.consumer._requeued))
+        self.consumer._connection.close.assert_called_once()
+
+    def test_shutdown_past_deadline(self):
+        self.consumer._request_stop(True, time.monotonic() - 1)
+        self.consumer._shutdown("tag")
+
+        # nothing waits on RabbitMQ, the connection is just closed
+        self.consumer._channel.basic_cancel.assert_not_called()
+        self.consumer._channel.basic_nack.assert_not_called()
+        self.consumer._connection.close.assert_called_once()
+
+
+class TestTracing(unittest.TestCase):
+    def test_trace_headers(self):
+        headers = trace_headers()
+        self.assertEqual(0, headers[HOPS_HEADER])
+
+        parent = varys_message(
+            pika.spec.Basic.Deliver(delivery_tag=1, exchange="test_varys"),
+            pika.BasicProperties(headers=headers),
+            b"{}",
+        )
+        child_headers = trace_headers(parent)
+        self.assertEqual(headers[TRACE_ID_HEADER], child_headers[TRACE_ID_HEADER])
+        self.assertEqual(1, child_headers[HOPS_HEADER])
+        self.assertGreaterEqual(child_headers[PUBLISHED_AT_HEADER], headers[PUBLISHED_AT_HEADER])
+
+    def test_untraced_message(self):
+        self.assertIsNone(read_trace_headers(pika.BasicProperties()))
+        self.assertIsNone(read_trace_headers(pika.BasicProperties(headers={"foo": "bar"})))
+
 
 if __name__ == '__main__':
     unittest.main()
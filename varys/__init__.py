@@ -1 +1,18 @@
-from varys.controller import Varys
+import importlib
+
+# submodules are only imported when first used, so `import varys` does not pay for pika and ssl
+_SUBMODULES = ("blob_store", "capture", "cli", "consumer", "controller", "memory", "process", "producer", "tracing", "utils")
+
+
+def __getattr__(name):
+    if name == "Varys":
+        return importlib.import_module("varys.controller").Varys
+
+    if name in _SUBMODULES:
+        return importlib.import_module(f"varys.{name}")
+
+    raise AttributeError(f"module 'varys' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted(list(globals()) + ["Varys"] + list(_SUBMODULES))
@@ -0,0 +1,201 @@
+from abc import ABC, abstractmethod
+from collections import Counter
+import threading
+import hashlib
+import json
+import uuid
+import weakref
+import os
+
+from varys.utils import varys_message
+
+
+CLAIM_CHECK_HEADER = "x-varys-claim-check"
+
+
+class BlobStore(ABC):
+    """
+    Base class for the stores used to offload oversized message bodies, which are sent as a claim check referencing the stored body instead.
+
+    Subclasses implement put, read and delete. Reference counting is handled here: a stored body is only deleted once every message holding it in this process has been settled and has either loaded its body or will never need to.
+
+    ...
+
+    Attributes
+    ----------
+    delete_after_ack : bool
+        whether to delete stored bodies once the messages referencing them have been acknowledged (or nacked without requeueing). Only enable this when each message is consumed by a single queue, as consumers of other queues bound to the same exchange may still need the body.
+
+    Methods
+    -------
+    put(data)
+        Store bytes and return a string reference to them
+    read(reference)
+        Return the stored bytes
+    delete(reference)
+        Remove stored bytes
+    acquire(reference)
+        Record a new holder of a reference
+    release(reference, settled=False)
+        Drop a holder of a reference, marking it for deletion if settled and delete_after_ack is set
+    """
+
+    def __init__(self, delete_after_ack=False):
+        self.delete_after_ack = delete_after_ack
+
+        self._references = Counter()
+        self._settled = set()
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def put(self, data):
+        pass
+
+    @abstractmethod
+    def read(self, reference):
+        pass
+
+    @abstractmethod
+    def delete(self, reference):
+        pass
+
+    def acquire(self, reference):
+        with self._lock:
+            self._references[reference] += 1
+
+    def release(self, reference, settled=False):
+        with self._lock:
+            self._references[reference] -= 1
+            if settled and self.delete_after_ack:
+                self._settled.add(reference)
+
+            if self._references[reference] > 0:
+                return
+
+            del self._references[reference]
+            if reference not in self._settled:
+                return
+            self._settled.discard(reference)
+
+        self.delete(reference)
+
+
+class FileBlobStore(BlobStore):
+    """
+    Stores message bodies as files in a directory, which must be shared by producers and consumers (e.g. on a network filesystem).
+    """
+
+    def __init__(self, directory, delete_after_ack=False):
+        super().__init__(delete_after_ack=delete_after_ack)
+
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, reference):
+        # references come from message bodies so must not be able to escape the directory
+        if os.path.basename(reference) != reference or reference.startswith("."):
+            raise ValueError(f"Invalid blob reference: {reference}")
+
+        return os.path.join(self.directory, reference)
+
+    def put(self, data):
+        reference = uuid.uuid4().hex
+        tmp_path = os.path.join(self.directory, "." + reference)
+
+        # write under a hidden name and rename, so a partially written body is never visible
+        with open(tmp_path, "wb") as blob_fh:
+            blob_fh.write(data)
+        os.replace(tmp_path, os.path.join(self.directory, reference))
+
+        return reference
+
+    def read(self, reference):
+        with open(self._path(reference), "rb") as blob_fh:
+            return blob_fh.read()
+
+    def delete(self, reference):
+        try:
+            os.remove(self._path(reference))
+        except FileNotFoundError:
+            pass
+
+
+def make_claim_check(blob_store, data):
+    """
+    Store data in blob_store and return the claim check message body referencing it.
+    """
+
+    return json.dumps(
+        {
+            "reference": blob_store.put(data),
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "size": len(data),
+        }
+    )
+
+
+class _BlobReference:
+    # a claim checked message's hold on its stored body, released once the body has been read or the message is garbage collected
+    # (tuples can't be weakly referenced, so the message can't be finalized itself)
+
+    def __init__(self, blob_store, reference):
+        blob_store.acquire(reference)
+        self.release = weakref.finalize(self, blob_store.release, reference)
+
+
+class claim_check_message(varys_message):
+    """
+    A varys_message whose body was offloaded to a blob store. The body is only fetched from the store, and its checksum verified, the first time it is accessed.
+
+    The message behaves like a varys_message holding the fetched body: unpacking it, indexing it, _asdict and _replace all fetch the body rather than returning the claim check, and _make, _replace and pickling return plain varys_messages. The claim check itself is available as the claim_check attribute. Comparisons and hashing still use the claim check, so they don't fetch the body.
+    """
+
+    def __new__(cls, basic_deliver, properties, body, blob_store):
+        message = super().__new__(cls, basic_deliver, properties, body)
+        message.claim_check = json.loads(body)
+        message._blob_store = blob_store
+        message._body = None
+        message._reference = _BlobReference(blob_store, message.claim_check["reference"])
+
+        return message
+
+    @property
+    def body(self):
+        if self._body is None:
+            reference = self.claim_check["reference"]
+            data = self._blob_store.read(reference)
+            if hashlib.sha256(data).hexdigest() != self.claim_check["sha256"]:
+                raise ValueError(f"Checksum mismatch for claim checked message body {reference}")
+            self._body = data
+
+            self._reference.release()
+
+        return self._body
+
+    def __iter__(self):
+        yield self.basic_deliver
+        yield self.properties
+        yield self.body
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+
+        if index in (2, -1):
+            return self.body
+
+        return super().__getitem__(index)
+
+    def _asdict(self):
+        return dict(zip(self._fields, self))
+
+    def _replace(self, **kwargs):
+        return varys_message(*self)._replace(**kwargs)
+
+    @classmethod
+    def _make(cls, iterable):
+        # there is no claim check to build one from, so make a plain message
+        return varys_message._make(iterable)
+
+    def __reduce__(self):
+        return varys_message, tuple(self)
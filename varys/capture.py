@@ -0,0 +1,245 @@
+import base64
+import gzip
+import json
+import mmap
+import time
+import zlib
+
+import pika
+
+from varys.blob_store import claim_check_message
+
+
+_PROPERTY_FIELDS = (
+    "content_type",
+    "content_encoding",
+    "headers",
+    "delivery_mode",
+    "priority",
+    "correlation_id",
+    "reply_to",
+    "expiration",
+    "message_id",
+    "timestamp",
+    "type",
+    "user_id",
+    "app_id",
+)
+
+
+def _properties_to_dict(properties):
+    if properties is None:
+        return {}
+
+    return {
+        field: getattr(properties, field)
+        for field in _PROPERTY_FIELDS
+        if getattr(properties, field, None) is not None
+    }
+
+
+class CaptureWriter:
+    """
+    Append varys messages to a capture file, one JSON record per line.
+
+    Captures with a path ending in ".gz" are gzip compressed, otherwise they are written as plain JSON lines. Each record is flushed to the file as soon as it is written, so an interrupted capture is still readable up to the last complete line.
+
+    ...
+
+    Methods
+    -------
+    write(message, received_at=None)
+        Append a varys_message to the capture, recording its delivery details, properties and the time it was received
+    close()
+        Flush and close the capture file
+    """
+
+    def __init__(self, capture_path):
+        self.capture_path = capture_path
+
+        if capture_path.endswith(".gz"):
+            self._fh = gzip.open(capture_path, "ab")
+        else:
+            self._fh = open(capture_path, "ab")
+
+        self.count = 0
+
+    def write(self, message, received_at=None):
+        if received_at is None:
+            received_at = time.time()
+
+        record = {
+            "received_at": received_at,
+            "exchange": message.basic_deliver.exchange,
+            "routing_key": message.basic_deliver.routing_key,
+            "redelivered": message.basic_deliver.redelivered,
+            "properties": _properties_to_dict(message.properties),
+        }
+
+        if isinstance(message, claim_check_message):
+            # record the claim check as it went over the wire, not the offloaded body
+            body = json.dumps(message.claim_check)
+        else:
+            body = message.body
+
+        if isinstance(body, bytes):
+            try:
+                body = body.decode("utf-8")
+            except UnicodeDecodeError:
+                # binary bodies can't go in JSON as they are
+                body = base64.b64encode(body).decode("ascii")
+                record["body_encoding"] = "base64"
+        record["body"] = body
+
+        self._fh.write(json.dumps(record, ensure_ascii=False, default=str).encode("utf-8") + b"\n")
+        if isinstance(self._fh, gzip.GzipFile):
+            # a sync flush ends on a byte boundary, so everything up to here can be decompressed even if the gzip trailer is never written
+            self._fh.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            self._fh.flush()
+        self.count += 1
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _record_body(entry):
+    if entry.get("body_encoding") == "base64":
+        return base64.b64decode(entry["body"])
+
+    return entry["body"].encode("utf-8")
+
+
+def read_capture(capture_path):
+    """
+    Iterate over the records in a capture file written by CaptureWriter.
+
+    The file is memory-mapped rather than read into memory, so captures larger than the available memory can be replayed.
+    """
+
+    with open(capture_path, "rb") as capture_fh:
+        # mmap cannot map an empty file
+        if capture_fh.seek(0, 2) == 0:
+            return
+
+        with mmap.mmap(capture_fh.fileno(), 0, access=mmap.ACCESS_READ) as capture_map:
+            if capture_path.endswith(".gz"):
+                lines = gzip.GzipFile(fileobj=capture_map, mode="rb")
+            else:
+                lines = iter(capture_map.readline, b"")
+
+            try:
+                for line in lines:
+                    # a line without a newline is a record cut off part way through being written
+                    if line.strip() and line.endswith(b"\n"):
+                        yield json.loads(line)
+            except EOFError:
+                # a gzip capture whose writer was killed has no trailer, but every flushed record is readable
+                pass
+
+
+def record(
+    varys_client,
+    exchange,
+    capture_path,
+    queue_suffix=False,
+    max_messages=None,
+    idle_timeout=None,
+    exchange_type="fanout",
+):
+    """
+    Record messages received from an exchange to a capture file, returning the number of messages recorded.
+
+    Recording stops after max_messages have been recorded or once no message has been received for idle_timeout seconds. If neither is provided it continues until interrupted.
+    """
+
+    with CaptureWriter(capture_path) as writer:
+        try:
+            while max_messages is None or writer.count < max_messages:
+                message = varys_client.receive(
+                    exchange,
+                    queue_suffix=queue_suffix,
+                    timeout=idle_timeout,
+                    exchange_type=exchange_type,
+                )
+                if message is None:
+                    break
+
+                writer.write(message)
+        except KeyboardInterrupt:
+            pass
+
+        return writer.count
+
+
+def replay(
+    varys_client,
+    exchange,
+    capture_path,
+    queue_suffix=False,
+    speed=1.0,
+    exchange_type="fanout",
+    max_attempts=1,
+    batch_size=100,
+):
+    """
+    Publish the messages in a capture file to an exchange, returning the number of messages sent.
+
+    Messages are sent with the intervals between them divided by speed, so 1.0 reproduces the original pacing and 2.0 replays twice as fast. A speed of 0 sends the messages as fast as possible.
+
+    Each message is published with its recorded body, routing key and properties rather than being re-serialised, so non-JSON bodies, routing keys and headers (e.g. trace and claim check headers) are replayed as captured. Header values which could not be stored in JSON were recorded as strings.
+
+    Messages which are due to be sent together are published in batches of up to batch_size, so RabbitMQ only has to be waited on once per batch.
+    """
+
+    if speed < 0:
+        raise ValueError("Replay speed must not be negative")
+
+    if batch_size < 1:
+        raise ValueError("Replay batch size must be at least 1")
+
+    producer = varys_client._get_producer(exchange, queue_suffix, exchange_type)
+
+    sent = 0
+    batch = []
+    first_received_at = None
+    started_at = time.monotonic()
+
+    for entry in read_capture(capture_path):
+        if speed > 0:
+            if first_received_at is None:
+                first_received_at = entry["received_at"]
+
+            delay = (entry["received_at"] - first_received_at) / speed
+            if started_at + delay > time.monotonic():
+                # send what is already due before waiting for this one
+                producer.publish_batch(batch, max_attempts=max_attempts)
+                sent += len(batch)
+                batch = []
+
+                wait = started_at + delay - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+
+        batch.append(
+            (
+                _record_body(entry),
+                entry.get("routing_key"),
+                pika.BasicProperties(**entry.get("properties", {})),
+            )
+        )
+        if len(batch) >= batch_size:
+            producer.publish_batch(batch, max_attempts=max_attempts)
+            sent += len(batch)
+            batch = []
+
+    producer.publish_batch(batch, max_attempts=max_attempts)
+    sent += len(batch)
+
+    return sent
@@ -0,0 +1,99 @@
+import argparse
+import sys
+
+from varys.controller import Varys
+from varys.capture import record, replay
+from varys.utils import ConfigurationError
+
+
+def _add_connection_args(parser):
+    parser.add_argument("--profile", required=True, help="profile name inside the varys configuration file")
+    parser.add_argument("--config", default=None, help="path to the varys configuration JSON, defaults to the VARYS_CFG environment variable")
+    parser.add_argument("--logfile", required=True, help="path to the logfile to use for logging")
+    parser.add_argument("--log-level", default="INFO", help="log level to use for logging")
+    parser.add_argument("--exchange", required=True, help="exchange to record from or replay to")
+    parser.add_argument("--queue-suffix", required=True, help="suffix of the queue bound to the exchange")
+    parser.add_argument("--exchange-type", default="fanout", help="type of the exchange (fanout, topic, direct, headers)")
+
+
+def _record(args):
+    varys_client = Varys(
+        args.profile,
+        args.logfile,
+        log_level=args.log_level,
+        config_path=args.config,
+    )
+    try:
+        count = record(
+            varys_client,
+            args.exchange,
+            args.output,
+            queue_suffix=args.queue_suffix,
+            max_messages=args.max_messages,
+            idle_timeout=args.idle_timeout,
+            exchange_type=args.exchange_type,
+        )
+    finally:
+        varys_client.close()
+
+    print(f"Recorded {count} messages to {args.output}", file=sys.stderr)
+
+
+def _replay(args):
+    varys_client = Varys(
+        args.profile,
+        args.logfile,
+        log_level=args.log_level,
+        config_path=args.config,
+    )
+    try:
+        count = replay(
+            varys_client,
+            args.exchange,
+            args.input,
+            queue_suffix=args.queue_suffix,
+            speed=args.speed,
+            exchange_type=args.exchange_type,
+            max_attempts=args.max_attempts,
+            batch_size=args.batch_size,
+        )
+    finally:
+        varys_client.close()
+
+    print(f"Replayed {count} messages from {args.input}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="varys", description="Record and replay RabbitMQ traffic with varys")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="record messages from an exchange to a capture file")
+    _add_connection_args(record_parser)
+    record_parser.add_argument("--output", required=True, help="capture file to append to, gzip compressed if it ends in .gz")
+    record_parser.add_argument("--max-messages", type=int, default=None, help="stop after recording this many messages")
+    record_parser.add_argument("--idle-timeout", type=float, default=None, help="stop after this many seconds without a message")
+    record_parser.set_defaults(func=_record)
+
+    replay_parser = subparsers.add_parser("replay", help="publish the messages in a capture file to an exchange")
+    _add_connection_args(replay_parser)
+    replay_parser.add_argument("--input", required=True, help="capture file to replay")
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="pacing multiplier, 1 for the original pacing, 0 to send as fast as possible",
+    )
+    replay_parser.add_argument("--max-attempts", type=int, default=1, help="attempts to make when sending each batch of messages")
+    replay_parser.add_argument("--batch-size", type=int, default=100, help="most messages to publish together")
+    replay_parser.set_defaults(func=_replay)
+
+    args = parser.parse_args(argv)
+    try:
+        args.func(args)
+    except ConfigurationError as e:
+        print(e, file=sys.stderr)
+        sys.exit(e.exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 import functools
+import queue
 import pika
 import time
 
 from varys.utils import varys_message
+from varys.blob_store import CLAIM_CHECK_HEADER, claim_check_message
 from varys.process import Process
+from varys.tracing import read_trace_headers
 
 
 class Consumer(Process):
@@ -19,6 +22,9 @@ class Consumer(Process):
         routing_key="arbitrary_string",
         reconnect_wait=10,
         prefetch_count=5,
+        trace_hook=None,
+        fan_in=None,
+        blob_store=None,
     ):
         super().__init__(
             message_queue,
@@ -30,20 +36,74 @@ class Consumer(Process):
             exchange_type,
             routing_key=routing_key,
             reconnect_wait=reconnect_wait,
+            trace_hook=trace_hook,
         )
 
         self._closing = False
         self._prefetch_count = prefetch_count
+        self._fan_in = fan_in
+        self._blob_store = blob_store
+
+        # delivery tag -> blob reference, for claim checked messages not yet acked or nacked
+        self._claim_checks = {}
+
+        # buffered messages handed back to RabbitMQ when the consumer stopped
+        self._requeued = []
+
+        # delivery tag -> (monotonic delivery time, trace), only populated when tracing
+        self._delivered_at = {}
 
     def _on_message(self, _unused_channel, basic_deliver, properties, body):
-        message = varys_message(basic_deliver, properties, body)
-        self._log.info(
-            f"Received Message: #{message.basic_deliver.delivery_tag} from {message.properties.app_id}, {message.body}"
-        )
-        self._message_queue.put(message)
+        if self._blob_store is not None and CLAIM_CHECK_HEADER in (properties.headers or {}):
+            # don't touch message.body here, the point is to only fetch it if the application wants it
+            message = claim_check_message(basic_deliver, properties, body, self._blob_store)
+            reference = message.claim_check["reference"]
+            self._blob_store.acquire(reference)
+            self._claim_checks[basic_deliver.delivery_tag] = reference
+            self._log.info(
+                f"Received Message: #{message.basic_deliver.delivery_tag} from {message.properties.app_id}, claim check {reference}"
+            )
+        else:
+            message = varys_message(basic_deliver, properties, body)
+            self._log.info(
+                f"Received Message: #{message.basic_deliver.delivery_tag} from {message.properties.app_id}, {message.body}"
+            )
+
+        if self._trace_hook is not None:
+            trace = read_trace_headers(properties) or (None, None, 0)
+            trace_id, published_at, hops = trace
+
+            enqueue_to_deliver = None
+            if published_at is not None:
+                enqueue_to_deliver = (time.time_ns() // 1000 - published_at) / 1e6
+
+            self._delivered_at[basic_deliver.delivery_tag] = (time.monotonic(), trace)
+            self._call_trace_hook("on_deliver", trace_id, hops, enqueue_to_deliver)
+
+        if self._fan_in is not None:
+            self._fan_in.put(self._exchange, self._message_queue, message)
+        else:
+            self._message_queue.put(message)
+
+    def _on_dequeue(self, message):
+        if self._trace_hook is None:
+            return
+
+        delivered = self._delivered_at.pop(message.basic_deliver.delivery_tag, None)
+        if delivered is None:
+            return
+
+        delivered_at, (trace_id, _, hops) = delivered
+        self._call_trace_hook("on_dequeue", trace_id, hops, time.monotonic() - delivered_at)
+
+    def _release_claim_check(self, delivery_tag, settled):
+        reference = self._claim_checks.pop(delivery_tag, None)
+        if reference is not None:
+            self._blob_store.release(reference, settled=settled)
 
     def _acknowledge_message(self, delivery_tag):
         self._log.info(f"Acknowledging message: {delivery_tag}")
+        self._release_claim_check(delivery_tag, settled=True)
         self._connection.add_callback_threadsafe(
             functools.partial(
                 self._channel.basic_ack,
@@ -53,6 +113,7 @@ class Consumer(Process):
 
     def _nack_message(self, delivery_tag, requeue):
         self._log.info(f"Nacking message: {delivery_tag}")
+        self._release_claim_check(delivery_tag, settled=not requeue)
         self._connection.add_callback_threadsafe(
             functools.partial(
                 self._channel.basic_nack,
@@ -68,6 +129,10 @@ class Consumer(Process):
                 # clear the queue, otherwise acking can cause problems on new channel
                 while not self._message_queue.empty():
                     self._message_queue.get()
+                self._delivered_at.clear()
+                # unacked messages are redelivered on the new channel
+                for delivery_tag in list(self._claim_checks):
+                    self._release_claim_check(delivery_tag, settled=False)
 
                 self._connection = pika.BlockingConnection(self._parameters)
                 self._channel = self._connection.channel()
@@ -79,34 +144,62 @@ class Consumer(Process):
                 self._channel.queue_declare(queue=self._queue, durable=True)
                 self._channel.queue_bind(queue=self._queue, exchange=self._exchange, routing_key=self._routing_key)
                 self._channel.basic_qos(prefetch_count=self._prefetch_count)
-                self._channel.basic_consume(self._queue, self._on_message, auto_ack=False)
-                self._channel.start_consuming()
+                consumer_tag = self._channel.basic_consume(self._queue, self._on_message, auto_ack=False)
+
+                # equivalent to start_consuming, but checks regularly whether we've been asked to stop
+                while not self._stopping:
+                    self._connection.process_data_events(time_limit=1)
+
+                self._shutdown(consumer_tag)
             except Exception as e:
                 self._log.exception("Consumer caught exception:")
 
             if self._stopping or self._reconnect_wait < 0:
                 break
             else:
-                time.sleep(self._reconnect_wait)
+                self._stop_event.wait(self._reconnect_wait)
                 continue
 
-    def stop(self):
-        self._log.info("Stopping consumer as instructed...")
-        self._stopping = True
+        self._log.debug("Stopping consumer logger...")
+        self._stop_logger()
 
-        self._connection.add_callback_threadsafe(
-            self._channel.stop_consuming
-        )
+    def _requeue_buffered(self):
+        # hand messages the application never received back to RabbitMQ for another consumer
+        # once the deadline has passed, leave the rest to be requeued when the connection closes
+        while self._time_left() != 0:
+            try:
+                message = self._message_queue.get_nowait()
+            except queue.Empty:
+                break
 
-        self._connection.add_callback_threadsafe(
-            self._channel.close
-        )
+            self._release_claim_check(message.basic_deliver.delivery_tag, settled=False)
+            self._channel.basic_nack(
+                delivery_tag=message.basic_deliver.delivery_tag,
+                multiple=False,
+                requeue=True,
+            )
+            self._requeued.append(message)
+
+    def _shutdown(self, consumer_tag):
+        try:
+            # each step waits on RabbitMQ, so check the deadline before each; past it, just close the connection
+            if self._drain and self._time_left() != 0:
+                # send any acks and nacks the application has already asked for
+                self._connection.process_data_events(time_limit=0)
+
+                if self._time_left() != 0:
+                    # stop deliveries; anything RabbitMQ sent in the meantime is nacked by pika
+                    self._channel.basic_cancel(consumer_tag)
+                    self._requeue_buffered()
+        finally:
+            self._close_connection()
 
-        self._connection.add_callback_threadsafe(
-            self._connection.close
-        )
+        self._log.info("Stopped consumer as instructed.")
 
-        self._log.debug("Stopping consumer logger...")
-        self._stop_logger()
+    def stop(self, drain=True, deadline=None):
+        """
+        Ask the consumer to stop; join the thread to wait for it. With drain, pending acks are sent and buffered messages are requeued before the connection is closed, otherwise they are left to RabbitMQ to requeue when the connection closes.
+        """
 
-        self._log.info("Stopped consumer as instructed.")
+        self._log.info("Stopping consumer as instructed...")
+        self._request_stop(drain, deadline)
@@ -4,7 +4,15 @@ import time
 
 from varys.consumer import Consumer
 from varys.producer import Producer
-from varys.utils import configurator
+from varys.memory import MemoryConsumer, MemoryProducer
+from varys.utils import FanIn, load_configuration
+
+
+# transport name -> (producer class, consumer class)
+TRANSPORTS = {
+    "amqp": (Producer, Consumer),
+    "memory": (MemoryProducer, MemoryConsumer),
+}
 
 
 class Varys:
@@ -19,6 +27,14 @@ class Varys:
         profile name inside the configuration file to use when connecting to RabbitMQ
     configuration_path : str
         path to varys confiruration JSON file, provided with either the config_path argument or the VARYS_CFG environment variable
+    trace_hook : TraceHook
+        an optional varys.tracing.TraceHook; when provided, sent messages are stamped with trace headers and publish, delivery and dequeue timings are reported to it
+    blob_store : BlobStore
+        an optional varys.blob_store.BlobStore; when provided, message bodies larger than claim_check_threshold bytes are offloaded to it and sent as a claim check, and received claim checks are fetched from it when their body is first accessed
+    claim_check_threshold : int
+        the size in bytes above which message bodies are offloaded to the blob store, defaults to 1 MiB
+    transport : str
+        "amqp" (the default) to connect to RabbitMQ, or "memory" to exchange messages between varys instances in the same python process through an in-memory broker, without needing a configuration file
     _logfile : str
         the path to the logfile to use for logging, provided with the logfile argument
     _log_level : str
@@ -32,16 +48,22 @@ class Varys:
 
     Methods
     -------
-    send(message, exchange, queue_suffix=False, exchange_type="fanout")
-        Either send a message to an existing exchange, or create a new exchange connection and send the message to it. queue_suffix must be provided when sending a message to a queue for the first time to instantiate a new connection.
+    send(message, exchange, queue_suffix=False, exchange_type="fanout", trace_parent=None)
+        Either send a message to an existing exchange, or create a new exchange connection and send the message to it. queue_suffix must be provided when sending a message to a queue for the first time to instantiate a new connection. trace_parent continues the trace of a received message when tracing is enabled.
     receive(exchange, queue_suffix=False, block=True, timeout=None, exchange_type="fanout")
         Either receive a message from an existing exchange, or create a new exchange connection and receive a message from it. queue_suffix must be provided when receiving a message from a queue for the first time to instantiate a new connection. block determines whether the receive method should block until a message is received or not.
     receive_batch(exchange, queue_suffix=False)
         Either receive a batch of messages from an existing exchange, or create a new exchange connection and receive a batch of messages from it. queue_suffix must be provided when receiving a message from a queue for the first time to instantiate a new connection.
+    receive_any(exchanges, queue_suffix=False, timeout=None, exchange_type="fanout")
+        Receive the next message available from any of several exchanges, returning None if timeout expires first. The source exchange is message.basic_deliver.exchange.
+    select(exchanges, timeout=None)
+        Return the exchanges, out of those already being received from, with messages waiting, blocking for up to timeout seconds until at least one does.
+    stream(exchange, queue_suffix=False, chunk_size=None, idle_timeout=None, stop_event=None, exchange_type="fanout")
+        Return a generator yielding messages (or chunks of messages) from an exchange as they arrive, acknowledging each once the next is requested. The generator ends after idle_timeout seconds without a message or once stop_event is set.
     get_channels()
         Return a dict of all the channels that have been connected to with the keys "consumer_channels" and "producer_channels"
-    close()
-        Close all open channels
+    close(timeout=None, drain=True)
+        Close all open channels in parallel, flushing pending messages and acknowledgements first if drain is set, and return a report of anything undelivered, requeued or not stopped within timeout seconds
     """
 
     def __init__(
@@ -52,7 +74,14 @@ class Varys:
         config_path=None,
         routing_key="arbitrary_string",
         auto_acknowledge=True,
+        trace_hook=None,
+        blob_store=None,
+        claim_check_threshold=1048576,
+        transport="amqp",
     ):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Transport must be one of: {', '.join(TRANSPORTS)}")
+
         self.profile = profile
 
         if config_path is None:
@@ -62,18 +91,41 @@ class Varys:
 
         self.routing_key = routing_key
         self.auto_ack = auto_acknowledge
+        self.trace_hook = trace_hook
+        self.blob_store = blob_store
+        self.claim_check_threshold = claim_check_threshold
 
         self._logfile = logfile
         self._log_level = log_level
 
-        self._credentials = configurator(self.profile, self.configuration_path)
+        self.transport = transport
+        self._producer_class, self._consumer_class = TRANSPORTS[transport]
+
+        # the memory transport never connects to RabbitMQ so needs no credentials
+        if transport == "memory":
+            self._credentials = None
+        else:
+            self._credentials = load_configuration(self.profile, self.configuration_path)
 
         self._in_channels = {}
         self._out_channels = {}
+        self._fan_in = FanIn()
 
-    def send(self, message, exchange, queue_suffix=False, exchange_type="fanout", max_attempts=1):
+    def send(self, message, exchange, queue_suffix=False, exchange_type="fanout", max_attempts=1, trace_parent=None):
         """
         Either send a message to an existing exchange, or create a new exchange connection and send the message to it.
+
+        When tracing is enabled, passing the received message this one was derived from as trace_parent continues its trace.
+        """
+
+        producer = self._get_producer(exchange, queue_suffix, exchange_type)
+        producer.publish_message(
+            message, max_attempts=max_attempts, trace_parent=trace_parent
+        )
+
+    def _get_producer(self, exchange, queue_suffix, exchange_type):
+        """
+        Return the producer for an exchange, creating and starting a new one if this is the first time the exchange has been sent to.
         """
 
         if not self._out_channels.get(exchange):
@@ -82,7 +134,7 @@ class Varys:
                     "Must provide a queue suffix when sending a message to a queue for the first time"
                 )
 
-            self._out_channels[exchange] = Producer(
+            producer = self._producer_class(
                 message_queue=queue.Queue(),
                 routing_key=self.routing_key,
                 exchange=exchange,
@@ -91,15 +143,25 @@ class Varys:
                 log_level=self._log_level,
                 queue_suffix=queue_suffix,
                 exchange_type=exchange_type,
+                trace_hook=self.trace_hook,
+                blob_store=self.blob_store,
+                claim_check_threshold=self.claim_check_threshold,
             )
-            self._out_channels[exchange].start()
-            time.sleep(0.1)
+            try:
+                producer.start()
+            except Exception:
+                # never started, so close would wait on it forever; release its log handler here instead
+                producer._stop_logger()
+                raise
 
-        self._out_channels[exchange].publish_message(message, max_attempts=max_attempts)
+            self._out_channels[exchange] = producer
+            time.sleep(producer.startup_wait)
 
-    def receive(self, exchange, queue_suffix=False, timeout=None, exchange_type="fanout"):
+        return self._out_channels[exchange]
+
+    def _get_consumer(self, exchange, queue_suffix, exchange_type, prefetch_count=5):
         """
-        Either receive a message from an existing exchange, or create a new exchange connection and receive a message from it.
+        Return the consumer for an exchange, creating and starting a new one if this is the first time the exchange has been received from.
         """
 
         if not self._in_channels.get(exchange):
@@ -108,7 +170,7 @@ class Varys:
                     "Must provide a queue suffix when receiving a message from an exchange for the first time"
                 )
 
-            self._in_channels[exchange] = Consumer(
+            consumer = self._consumer_class(
                 message_queue=queue.Queue(),
                 routing_key=self.routing_key,
                 exchange=exchange,
@@ -117,23 +179,79 @@ class Varys:
                 log_level=self._log_level,
                 queue_suffix=queue_suffix,
                 exchange_type=exchange_type,
+                prefetch_count=prefetch_count,
+                trace_hook=self.trace_hook,
+                fan_in=self._fan_in,
+                blob_store=self.blob_store,
             )
-            self._in_channels[exchange].start()
-            time.sleep(0.1)
+            try:
+                consumer.start()
+            except Exception:
+                # never started, so close would wait on it forever; release its log handler here instead
+                consumer._stop_logger()
+                raise
+
+            self._in_channels[exchange] = consumer
+            time.sleep(consumer.startup_wait)
+
+        return self._in_channels[exchange]
+
+    def receive(self, exchange, queue_suffix=False, timeout=None, exchange_type="fanout"):
+        """
+        Either receive a message from an existing exchange, or create a new exchange connection and receive a message from it.
+        """
+
+        consumer = self._get_consumer(exchange, queue_suffix, exchange_type)
 
         try:
-            message = self._in_channels[exchange]._message_queue.get(
-                block=True, timeout=timeout
-            )
+            message = consumer._message_queue.get(block=True, timeout=timeout)
+            consumer._on_dequeue(message)
             if self.auto_ack:
                 # Only ack a message when it is pulled out of the thread-safe queue and auto_ack is set
-                self._in_channels[exchange]._acknowledge_message(
+                consumer._acknowledge_message(
                     message.basic_deliver.delivery_tag
                 )
             return message
         except queue.Empty:
             return None
 
+    def receive_any(self, exchanges, queue_suffix=False, timeout=None, exchange_type="fanout"):
+        """
+        Receive the next message available from any of several exchanges, creating new exchange connections for any that have not been received from before.
+
+        The exchange the message came from is message.basic_deliver.exchange, so it can be acknowledged or nacked as usual. Returns None if no message arrives within timeout seconds.
+        """
+
+        for exchange in exchanges:
+            self._get_consumer(exchange, queue_suffix, exchange_type)
+
+        received = self._fan_in.get(exchanges, timeout=timeout)
+        if received is None:
+            return None
+
+        exchange, message = received
+        consumer = self._in_channels[exchange]
+        consumer._on_dequeue(message)
+        if self.auto_ack:
+            consumer._acknowledge_message(message.basic_deliver.delivery_tag)
+
+        return message
+
+    def select(self, exchanges, timeout=None):
+        """
+        Return the list of exchanges, out of those already being received from, which have messages waiting, blocking for up to timeout seconds until at least one does.
+
+        Returns an empty list if timeout expires without a message arriving.
+        """
+
+        for exchange in exchanges:
+            if not self._in_channels.get(exchange):
+                raise Exception(
+                    f"Cannot select on exchange {exchange} before it has been received from"
+                )
+
+        return self._fan_in.ready(exchanges, timeout=timeout)
+
     def receive_batch(self, exchange, queue_suffix=False, timeout=0, exchange_type="fanout"):
         """
         Either receive all messages available from an existing exchange, or create a new exchange connection and receive all messages available from it.
@@ -157,6 +275,85 @@ class Varys:
 
         return messages
 
+    def _next_chunk(self, consumer, chunk_size, idle_timeout, stop_event, poll_interval):
+        # wait for the first message, waking up regularly to check the stop signal
+        deadline = None if idle_timeout is None else time.monotonic() + idle_timeout
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                return []
+
+            wait = None if stop_event is None else poll_interval
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+                wait = remaining if wait is None else min(wait, remaining)
+
+            try:
+                chunk = [consumer._message_queue.get(block=True, timeout=wait)]
+                break
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return []
+
+        # then take whatever else has already been prefetched, up to the chunk size
+        while len(chunk) < chunk_size:
+            try:
+                chunk.append(consumer._message_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return chunk
+
+    def stream(
+        self,
+        exchange,
+        queue_suffix=False,
+        chunk_size=None,
+        idle_timeout=None,
+        stop_event=None,
+        exchange_type="fanout",
+        poll_interval=0.1,
+    ):
+        """
+        Yield messages from an exchange as they arrive, or lists of up to chunk_size messages if chunk_size is provided.
+
+        Where auto_acknowledge is set, each message (or chunk) is acknowledged once the next one is requested, i.e. when the body of the consuming loop has finished with it. If the loop exits early, the message in hand is requeued rather than acknowledged. The stream ends once no message has arrived for idle_timeout seconds or once stop_event (a threading.Event) is set, otherwise it continues indefinitely.
+
+        The consumer keeps prefetching messages while the loop body runs. A new consumer is created with a prefetch count of at least chunk_size so that full chunks can be filled; an existing consumer keeps its prefetch count.
+        """
+
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+
+        consumer = self._get_consumer(
+            exchange,
+            queue_suffix,
+            exchange_type,
+            prefetch_count=max(5, chunk_size or 0),
+        )
+
+        pending = []
+        try:
+            while True:
+                pending = self._next_chunk(
+                    consumer, chunk_size or 1, idle_timeout, stop_event, poll_interval
+                )
+                if not pending:
+                    return
+
+                for message in pending:
+                    consumer._on_dequeue(message)
+
+                yield pending if chunk_size else pending[0]
+
+                if self.auto_ack:
+                    for message in pending:
+                        consumer._acknowledge_message(message.basic_deliver.delivery_tag)
+                pending = []
+        finally:
+            if self.auto_ack:
+                for message in pending:
+                    consumer._nack_message(message.basic_deliver.delivery_tag, requeue=True)
+
     def acknowledge_message(self, message):
         """
         Acknowledge a message manually. Not necessary by default where auto_acknowledge is set to True.
@@ -189,13 +386,35 @@ class Varys:
             "producer_channels": self._out_channels.keys(),
         }
 
-    def close(self):
-        """Close all open channels."""
+    def close(self, timeout=None, drain=True):
+        """
+        Close all open channels, returning a report of anything that could not be delivered.
+
+        All channels are shut down in parallel. With drain, producers first flush messages still waiting to be published or confirmed, and consumers send pending acknowledgements and requeue buffered messages that were never received. No more than timeout seconds are spent in total, if provided.
+
+        The report is a dict with the keys "undelivered" (exchange -> serialised messages which were refused or unconfirmed), "requeued" (exchange -> buffered messages handed back to RabbitMQ) and "timed_out" (exchanges whose channels had not stopped by the timeout).
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        channels = list(self._in_channels.items()) + list(self._out_channels.items())
+
+        for _, channel in channels:
+            channel.stop(drain=drain, deadline=deadline)
+
+        report = {"undelivered": {}, "requeued": {}, "timed_out": []}
+
+        for exchange, channel in channels:
+            channel.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+            if channel.is_alive():
+                report["timed_out"].append(exchange)
+
+        for exchange, channel in self._out_channels.items():
+            undelivered = channel._undelivered_messages()
+            if undelivered:
+                report["undelivered"][exchange] = undelivered
 
-        for channel in self._in_channels.values():
-            channel.stop()
-            channel.join()
+        for exchange, channel in self._in_channels.items():
+            if channel._requeued:
+                report["requeued"][exchange] = list(channel._requeued)
 
-        for channel in self._out_channels.values():
-            channel.stop()
-            channel.join()
+        return report
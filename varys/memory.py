@@ -0,0 +1,286 @@
+from collections import deque, namedtuple
+import threading
+from queue import Empty
+
+import pika
+
+from varys.consumer import Consumer
+from varys.producer import Producer
+
+
+# a message sitting in a MemoryBroker queue
+_entry = namedtuple("_entry", "exchange routing_key properties body redelivered")
+
+
+def _topic_matches(binding_words, routing_words):
+    # AMQP topic matching: "*" matches exactly one word, "#" matches zero or more
+    if not binding_words:
+        return not routing_words
+
+    word = binding_words[0]
+    if word == "#":
+        return any(
+            _topic_matches(binding_words[1:], routing_words[i:])
+            for i in range(len(routing_words) + 1)
+        )
+
+    if not routing_words:
+        return False
+
+    if word == "*" or word == routing_words[0]:
+        return _topic_matches(binding_words[1:], routing_words[1:])
+
+    return False
+
+
+class MemoryBroker:
+    """
+    An in-process stand-in for RabbitMQ, used by the "memory" transport. It supports fanout, direct and topic exchanges, durable queues, prefetch limits, acknowledgements and redelivery, and lets producers and consumers in the same process exchange messages without a broker.
+
+    Everything is guarded by a single condition variable, which consumers wait on for messages to arrive or for prefetch capacity to be freed.
+
+    ...
+
+    Methods
+    -------
+    declare_exchange(exchange, exchange_type)
+        Create an exchange, or check an existing one has the same type
+    declare_queue(queue)
+        Create a queue if it does not exist
+    bind_queue(queue, exchange, routing_key)
+        Route messages published to exchange to queue, according to the exchange type and routing key
+    publish(exchange, routing_key, properties, body)
+        Route a message to the bound queues, returning the number of queues it was routed to
+    reset()
+        Drop all exchanges, queues and messages
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        with self.condition:
+            self._exchanges = {}
+            self._bindings = {}
+            self.queues = {}
+
+    def declare_exchange(self, exchange, exchange_type):
+        if exchange_type not in ("fanout", "direct", "topic"):
+            raise ValueError(
+                "The memory transport only supports fanout, direct and topic exchanges"
+            )
+
+        with self.condition:
+            existing = self._exchanges.setdefault(exchange, exchange_type)
+            if existing != exchange_type:
+                raise ValueError(
+                    f"Exchange {exchange} already declared with type {existing}, not {exchange_type}"
+                )
+            self._bindings.setdefault(exchange, [])
+
+    def declare_queue(self, queue):
+        with self.condition:
+            self.queues.setdefault(queue, deque())
+
+    def bind_queue(self, queue, exchange, routing_key):
+        with self.condition:
+            if (queue, routing_key) not in self._bindings[exchange]:
+                self._bindings[exchange].append((queue, routing_key))
+
+    def _routes(self, exchange, routing_key):
+        exchange_type = self._exchanges[exchange]
+
+        for queue, binding_key in self._bindings[exchange]:
+            if exchange_type == "fanout":
+                yield queue
+            elif exchange_type == "direct":
+                if binding_key == routing_key:
+                    yield queue
+            elif _topic_matches(binding_key.split("."), routing_key.split(".")):
+                yield queue
+
+    def publish(self, exchange, routing_key, properties, body):
+        with self.condition:
+            # a queue bound with several keys only gets one copy
+            queues = set(self._routes(exchange, routing_key))
+            for queue in queues:
+                self.queues[queue].append(
+                    _entry(exchange, routing_key, properties, body, False)
+                )
+
+            if queues:
+                self.condition.notify_all()
+
+        return len(queues)
+
+
+_broker = MemoryBroker()
+
+
+def get_broker():
+    """Return the process-wide MemoryBroker shared by every varys instance using the memory transport."""
+
+    return _broker
+
+
+class MemoryProducer(Producer):
+    """
+    A Producer which publishes to a MemoryBroker rather than RabbitMQ. Messages are routed synchronously, so publishing never has to wait on a connection.
+    """
+
+    startup_wait = 0
+
+    def __init__(self, *args, broker=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._broker = broker if broker is not None else get_broker()
+
+    def start(self):
+        # declare before starting so messages can be published as soon as start returns
+        self._broker.declare_exchange(self._exchange, self._exchange_type.value)
+        self._broker.declare_queue(self._queue)
+        self._broker.bind_queue(self._queue, self._exchange, self._routing_key)
+
+        super().start()
+
+    def _basic_publish(self, message_str, properties, routing_key=None):
+        if routing_key is None:
+            routing_key = self._routing_key
+
+        body = message_str.encode("utf-8") if isinstance(message_str, str) else message_str
+        if not self._broker.publish(self._exchange, routing_key, properties, body):
+            self._log.warning(f"Message to {self._exchange} was not routed to any queue")
+            self._undelivered.append(message_str)
+
+    def _basic_publish_batch(self, batch):
+        for message_str, properties, routing_key in batch:
+            self._basic_publish(message_str, properties, routing_key=routing_key)
+
+    def run(self):
+        # publishing happens in the caller's thread, so there is nothing to do until we're stopped
+        self._stop_event.wait()
+        self._log.info("Stopped producer as instructed.")
+
+        self._log.debug("Stopping producer logger...")
+        self._stop_logger()
+
+    def stop(self, drain=True, deadline=None):
+        self._log.info("Stopping producer as instructed...")
+        self._request_stop(drain, deadline)
+
+
+class MemoryConsumer(Consumer):
+    """
+    A Consumer which receives from a MemoryBroker rather than RabbitMQ. At most prefetch_count messages are delivered without being acknowledged, and any still unacknowledged when the consumer stops are requeued for redelivery.
+    """
+
+    startup_wait = 0
+
+    def __init__(self, *args, broker=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._broker = broker if broker is not None else get_broker()
+        self._consumer_tag = f"varys.memory.{id(self)}"
+        self._delivery_tag = 0
+        # delivery tag -> _entry, for messages delivered but not yet acked or nacked
+        self._unacked = {}
+
+    def start(self):
+        self._broker.declare_exchange(self._exchange, self._exchange_type.value)
+        self._broker.declare_queue(self._queue)
+        self._broker.bind_queue(self._queue, self._exchange, self._routing_key)
+
+        super().start()
+
+    def _acknowledge_message(self, delivery_tag):
+        self._log.info(f"Acknowledging message: {delivery_tag}")
+        self._release_claim_check(delivery_tag, settled=True)
+
+        with self._broker.condition:
+            self._unacked.pop(delivery_tag, None)
+            self._broker.condition.notify_all()
+
+    def _nack_message(self, delivery_tag, requeue):
+        self._log.info(f"Nacking message: {delivery_tag}")
+        self._release_claim_check(delivery_tag, settled=not requeue)
+
+        with self._broker.condition:
+            entry = self._unacked.pop(delivery_tag, None)
+            if entry is not None and requeue:
+                self._broker.queues[self._queue].appendleft(entry._replace(redelivered=True))
+            self._broker.condition.notify_all()
+
+    def _next_entry(self):
+        # wait for a message, as long as we're under the prefetch limit
+        with self._broker.condition:
+            broker_queue = self._broker.queues[self._queue]
+            while not self._stopping and (
+                not broker_queue or len(self._unacked) >= self._prefetch_count
+            ):
+                self._broker.condition.wait()
+
+            if self._stopping:
+                return None, None
+
+            self._delivery_tag += 1
+            entry = broker_queue.popleft()
+            self._unacked[self._delivery_tag] = entry
+
+            return self._delivery_tag, entry
+
+    def run(self):
+        try:
+            while True:
+                delivery_tag, entry = self._next_entry()
+                if entry is None:
+                    break
+
+                basic_deliver = pika.spec.Basic.Deliver(
+                    consumer_tag=self._consumer_tag,
+                    delivery_tag=delivery_tag,
+                    redelivered=entry.redelivered,
+                    exchange=entry.exchange,
+                    routing_key=entry.routing_key,
+                )
+                self._on_message(None, basic_deliver, entry.properties, entry.body)
+        except Exception:
+            self._log.exception("Consumer caught exception:")
+        finally:
+            if self._drain:
+                self._requeue_buffered()
+
+            # like closing a channel, requeue anything delivered but not acked
+            for delivery_tag in list(self._claim_checks):
+                self._release_claim_check(delivery_tag, settled=False)
+
+            with self._broker.condition:
+                broker_queue = self._broker.queues[self._queue]
+                for delivery_tag in sorted(self._unacked, reverse=True):
+                    broker_queue.appendleft(self._unacked.pop(delivery_tag)._replace(redelivered=True))
+                self._broker.condition.notify_all()
+
+            self._log.info("Stopped consumer as instructed.")
+
+            self._log.debug("Stopping consumer logger...")
+            self._stop_logger()
+
+    def _requeue_buffered(self):
+        buffered = []
+        while True:
+            try:
+                buffered.append(self._message_queue.get_nowait())
+            except Empty:
+                break
+
+        # nacked messages go to the front of the queue, so go backwards to keep their order
+        for message in reversed(buffered):
+            self._nack_message(message.basic_deliver.delivery_tag, requeue=True)
+        self._requeued.extend(buffered)
+
+    def stop(self, drain=True, deadline=None):
+        self._log.info("Stopping consumer as instructed...")
+
+        with self._broker.condition:
+            self._request_stop(drain, deadline)
+            self._broker.condition.notify_all()
@@ -1,4 +1,5 @@
-from threading import Thread
+from threading import Event, Thread, Lock
+import time
 from os import path
 import ssl
 import logging
@@ -6,7 +7,61 @@ import logging
 import pika
 
 
+_ssl_options_cache = {}
+_ssl_options_lock = Lock()
+
+
+def _ssl_options(configuration):
+    # loading the CA bundle is the expensive part of connecting, so the SSL options are built once per configuration file version and profile
+    cache_key = getattr(configuration, "cache_key", None)
+
+    with _ssl_options_lock:
+        if cache_key is not None and cache_key in _ssl_options_cache:
+            return _ssl_options_cache[cache_key]
+
+        context = ssl.create_default_context(
+            purpose=ssl.Purpose.SERVER_AUTH,
+            cafile=configuration.ca_certificate,
+        )
+        # default behaviour for Purpose.SERVERAUTH
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.check_hostname = True
+
+        ssl_options = pika.SSLOptions(context, configuration.ampq_url)
+
+        if cache_key is not None:
+            # drop options built from older versions of the same file and profile
+            for stale_key in [
+                key for key in _ssl_options_cache if key[0] == cache_key[0] and key[-1] == cache_key[-1]
+            ]:
+                del _ssl_options_cache[stale_key]
+
+            _ssl_options_cache[cache_key] = ssl_options
+
+    return ssl_options
+
+
+def connection_parameters(configuration):
+    """
+    Return new pika ConnectionParameters for a configuration.
+
+    pika modifies the parameters it is given while connecting, so each process needs its own; only the SSL options, including the SSL context and its loaded CA bundle, are shared.
+    """
+
+    return pika.ConnectionParameters(
+        host=configuration.ampq_url,
+        port=configuration.port,
+        credentials=pika.PlainCredentials(
+            username=configuration.username, password=configuration.password
+        ),
+        ssl_options=_ssl_options(configuration) if configuration.use_tls else None,
+    )
+
+
 class Process(Thread):
+    # seconds to give a newly started process to connect before it is used
+    startup_wait = 0.1
+
     def __init__(
         self,
         message_queue,
@@ -18,6 +73,7 @@ class Process(Thread):
         exchange_type,
         routing_key="arbitrary_string",
         reconnect_wait=10,
+        trace_hook=None,
     ):
         super().__init__()
 
@@ -31,7 +87,11 @@ class Process(Thread):
         self._connection = None
         self._channel = None
         self._stopping = False
+        self._stop_event = Event()
+        self._drain = True
+        self._stop_deadline = None
         self._reconnect_wait = reconnect_wait
+        self._trace_hook = trace_hook
 
         if exchange_type == "fanout":
             self._exchange_type = pika.exchange_type.ExchangeType.fanout
@@ -46,27 +106,49 @@ class Process(Thread):
                 "Exchange type must be one of: fanout, topic, direct, headers"
             )
 
-        if configuration.use_tls:
-            context = ssl.create_default_context(
-                purpose=ssl.Purpose.SERVER_AUTH,
-                cafile=configuration.ca_certificate,
-            )
-            # default behaviour for Purpose.SERVERAUTH
-            context.verify_mode = ssl.CERT_REQUIRED
-            context.check_hostname = True
-
-            ssl_options = pika.SSLOptions(context, configuration.ampq_url)
+        # transports which don't connect to RabbitMQ have no configuration
+        if configuration is not None:
+            self._parameters = connection_parameters(configuration)
         else:
-            ssl_options = None
-
-        self._parameters = pika.ConnectionParameters(
-            host=configuration.ampq_url,
-            port=configuration.port,
-            credentials=pika.PlainCredentials(
-                username=configuration.username, password=configuration.password
-            ),
-            ssl_options=ssl_options,
-        )
+            self._parameters = None
+
+    def _request_stop(self, drain, deadline):
+        # only flags the stop, the process' own thread does the actual shutting down
+        self._drain = drain
+        self._stop_deadline = deadline
+        self._stopping = True
+        self._stop_event.set()
+
+        # wake the connection up so that run notices straight away
+        if self._connection is not None and self._connection.is_open:
+            try:
+                self._connection.add_callback_threadsafe(lambda: None)
+            except pika.exceptions.ConnectionWrongStateError:
+                pass
+
+    def _time_left(self):
+        # seconds left before the stop deadline, or None if there is no deadline
+        if self._stop_deadline is None:
+            return None
+
+        return max(self._stop_deadline - time.monotonic(), 0)
+
+    def _close_connection(self):
+        for close in (getattr(self._channel, "close", None), getattr(self._connection, "close", None)):
+            if close is None:
+                continue
+            try:
+                close()
+            except pika.exceptions.AMQPError:
+                # already closed, e.g. by the broker
+                pass
+
+    def _call_trace_hook(self, method, *args):
+        # a misbehaving hook must never interrupt sending or receiving messages
+        try:
+            getattr(self._trace_hook, method)(self._exchange, *args)
+        except Exception:
+            self._log.exception(f"Trace hook {method} raised an exception:")
 
     def _setup_logger(self, log_level):
         name = self._exchange
@@ -78,7 +160,8 @@ class Process(Thread):
 
         # if the filename is already associated with a handler, increase the count
         try:
-            handler_filenames = [fh.baseFilename for fh in self._log.handlers]
+            # other tools (e.g. pytest) may attach handlers which aren't file handlers
+            handler_filenames = [getattr(fh, "baseFilename", None) for fh in self._log.handlers]
             index = handler_filenames.index(log_path)
             self._log.handlers[index].count += 1
         # otherwise create a new filehandler (with initial count 1)
@@ -95,7 +178,7 @@ class Process(Thread):
     def _stop_logger(self):
         log_path = self._log_file
 
-        handler_filenames = [fh.baseFilename for fh in self._log.handlers]
+        handler_filenames = [getattr(fh, "baseFilename", None) for fh in self._log.handlers]
         index = handler_filenames.index(log_path)
         self._log.handlers[index].count -= 1
 
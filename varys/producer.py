@@ -1,9 +1,21 @@
 import functools
+import itertools
+import threading
 import pika
 import time
 import json
 
 from varys.process import Process
+from varys.blob_store import CLAIM_CHECK_HEADER, make_claim_check
+from varys.tracing import HOPS_HEADER, TRACE_ID_HEADER, trace_headers
+
+
+# errors after which a message is kept to be published again on a new connection
+_RETRYABLE_ERRORS = (
+    pika.exceptions.AMQPConnectionError,
+    pika.exceptions.ChannelClosed,
+    pika.exceptions.ChannelWrongStateError,
+)
 
 
 class Producer(Process):
@@ -18,6 +30,9 @@ class Producer(Process):
         exchange_type,
         routing_key="arbitrary_string",
         reconnect_wait=10,
+        trace_hook=None,
+        blob_store=None,
+        claim_check_threshold=1048576,
     ):
         super().__init__(
             message_queue,
@@ -29,35 +44,239 @@ class Producer(Process):
             exchange_type,
             routing_key=routing_key,
             reconnect_wait=reconnect_wait,
+            trace_hook=trace_hook,
         )
 
         self._message_number = 0
+        self._blob_store = blob_store
+        self._claim_check_threshold = claim_check_threshold
 
         self._message_properties = pika.BasicProperties(
             content_type="json", delivery_mode=pika.DeliveryMode.Persistent,
         )
 
-    def publish_message(self, message, max_attempts=1):
+        # publish id -> (message_str, properties, routing_key) for messages not yet confirmed by RabbitMQ
+        self._pending = {}
+        # publish ids currently being published, so a resend can't publish them a second time
+        self._in_flight = set()
+        self._pending_lock = threading.Lock()
+        self._publish_ids = itertools.count()
+        # message_str of messages RabbitMQ refused
+        self._undelivered = []
+        # channel in transaction mode for publishing batches, opened on first use
+        self._batch_channel = None
+
+    def _publish_pending(self, publish_id, message_str, properties, routing_key):
+        # runs in the connection's thread; with confirms enabled this blocks until RabbitMQ accepts or refuses the message
+        # a message can be scheduled both by _basic_publish and by the resend after reconnecting, so only publish it once
+        with self._pending_lock:
+            if publish_id not in self._pending or publish_id in self._in_flight:
+                return
+            self._in_flight.add(publish_id)
+
+        try:
+            try:
+                self._channel.basic_publish(
+                    self._exchange,
+                    routing_key,
+                    message_str,
+                    properties,
+                    mandatory=True,
+                )
+            except _RETRYABLE_ERRORS:
+                # the connection or channel went away, so leave it pending to be resent once reconnected
+                raise
+            except (pika.exceptions.UnroutableError, pika.exceptions.NackError):
+                self._log.exception(f"RabbitMQ did not accept message: {message_str}")
+                self._undelivered.append(message_str)
+            except Exception:
+                # e.g. properties pika can't encode; resending would fail the same way on every connection
+                self._log.exception(f"Unable to publish message: {message_str}")
+                self._undelivered.append(message_str)
+
+            with self._pending_lock:
+                self._pending.pop(publish_id, None)
+        finally:
+            with self._pending_lock:
+                self._in_flight.discard(publish_id)
+
+    def _batch_channel_for_connection(self):
+        if self._batch_channel is None or not self._batch_channel.is_open:
+            self._batch_channel = self._connection.channel()
+            self._batch_channel.tx_select()
+            self._batch_channel.add_on_return_callback(self._on_batch_return)
+
+        return self._batch_channel
+
+    def _on_batch_return(self, _unused_channel, _unused_method, _unused_properties, body):
+        self._log.error(f"RabbitMQ did not accept message: {body}")
+        self._undelivered.append(body)
+
+    def _publish_pending_batch(self, batch):
+        # runs in the connection's thread; the batch is published in a transaction so there is one round trip for all of it, rather than a confirm for each message
+        with self._pending_lock:
+            batch = [
+                message
+                for message in batch
+                if message[0] in self._pending and message[0] not in self._in_flight
+            ]
+            self._in_flight.update(publish_id for publish_id, _, _, _ in batch)
+
+        if not batch:
+            return
+
+        try:
+            channel = self._batch_channel_for_connection()
+
+            published = []
+            for publish_id, message_str, properties, routing_key in batch:
+                try:
+                    channel.basic_publish(
+                        self._exchange,
+                        routing_key,
+                        message_str,
+                        properties,
+                        mandatory=True,
+                    )
+                except _RETRYABLE_ERRORS:
+                    # nothing is published until the commit, so the whole batch is left pending to be resent
+                    raise
+                except Exception:
+                    self._log.exception(f"Unable to publish message: {message_str}")
+                    self._undelivered.append(message_str)
+                    with self._pending_lock:
+                        self._pending.pop(publish_id, None)
+                    continue
+
+                published.append(publish_id)
+
+            # unroutable messages are returned to _on_batch_return
+            channel.tx_commit()
+
+            with self._pending_lock:
+                for publish_id in published:
+                    self._pending.pop(publish_id, None)
+        finally:
+            with self._pending_lock:
+                self._in_flight.difference_update(publish_id for publish_id, _, _, _ in batch)
+
+    def _basic_publish_batch(self, batch):
+        publish_ids = []
+        with self._pending_lock:
+            for message_str, properties, routing_key in batch:
+                publish_id = next(self._publish_ids)
+                self._pending[publish_id] = (message_str, properties, routing_key)
+                publish_ids.append(publish_id)
+
+        try:
+            self._connection.add_callback_threadsafe(
+                functools.partial(
+                    self._publish_pending_batch,
+                    [(publish_id,) + message for publish_id, message in zip(publish_ids, batch)],
+                )
+            )
+        except pika.exceptions.ConnectionWrongStateError:
+            with self._pending_lock:
+                for publish_id in publish_ids:
+                    self._pending.pop(publish_id, None)
+            raise
+
+    def _basic_publish(self, message_str, properties, routing_key=None):
+        if routing_key is None:
+            routing_key = self._routing_key
+
+        publish_id = next(self._publish_ids)
+        with self._pending_lock:
+            self._pending[publish_id] = (message_str, properties, routing_key)
+
+        # pika is not thread-safe, so hand the publish over to the connection's thread
+        try:
+            self._connection.add_callback_threadsafe(
+                functools.partial(self._publish_pending, publish_id, message_str, properties, routing_key)
+            )
+        except pika.exceptions.ConnectionWrongStateError:
+            with self._pending_lock:
+                self._pending.pop(publish_id, None)
+            raise
+
+    def _undelivered_messages(self):
+        """Return the messages which were refused by RabbitMQ or are still waiting to be confirmed."""
+
+        with self._pending_lock:
+            pending = [message_str for message_str, _, _ in self._pending.values()]
+
+        return self._undelivered + pending
+
+    def publish_message(self, message, max_attempts=1, trace_parent=None):
         try:
             message_str = json.dumps(message, ensure_ascii=False)
         except TypeError:
             self._log.error(f"Unable to serialise message into json: {str(message)}")
 
+        headers = {}
+
+        if self._blob_store is not None:
+            message_bytes = message_str.encode("utf-8")
+            if len(message_bytes) > self._claim_check_threshold:
+                message_str = make_claim_check(self._blob_store, message_bytes)
+                headers[CLAIM_CHECK_HEADER] = 1
+                self._log.info(f"Offloaded {len(message_bytes)} byte message body: {message_str}")
+
+        if self._trace_hook is not None:
+            headers.update(trace_headers(trace_parent))
+            self._call_trace_hook("on_publish", headers[TRACE_ID_HEADER], headers[HOPS_HEADER])
+
+        if headers:
+            properties = pika.BasicProperties(
+                content_type="json",
+                delivery_mode=pika.DeliveryMode.Persistent,
+                headers=headers,
+            )
+        else:
+            properties = self._message_properties
+
+        self._publish(message_str, properties, max_attempts)
+
+    def publish_batch(self, messages, max_attempts=1):
+        """
+        Publish several (body, routing_key, properties) messages exactly as given, e.g. when replaying captured traffic. RabbitMQ is waited on once for the whole batch, rather than for each message. routing_key and properties may be None to use those used by publish_message.
+        """
+
+        batch = [
+            (
+                body,
+                self._message_properties if properties is None else properties,
+                self._routing_key if routing_key is None else routing_key,
+            )
+            for body, routing_key, properties in messages
+        ]
+        if not batch:
+            return
+
+        for message_str, _, _ in batch:
+            self._log.debug(f"Sending message: {message_str}")
+
+        self._with_attempts(functools.partial(self._basic_publish_batch, batch), max_attempts)
+
+        self._message_number += len(batch)
+        self._log.info(f"Published {len(batch)} messages, up to #{self._message_number}")
+
+    def _publish(self, message_str, properties, max_attempts, routing_key=None):
+        self._log.debug(f"Sending message: {message_str}")
+        self._with_attempts(
+            functools.partial(self._basic_publish, message_str, properties, routing_key=routing_key),
+            max_attempts,
+        )
+
+        self._message_number += 1
+        self._log.info(f"Published message #{self._message_number}")
+
+    def _with_attempts(self, publish, max_attempts):
         attempt = 0
         while attempt < max_attempts:
             try:
                 attempt += 1
-                self._log.info(f"Sending message (attempt {attempt}): {json.dumps(message)}")
-                self._connection.add_callback_threadsafe(
-                    functools.partial(
-                        self._channel.basic_publish,
-                        self._exchange,
-                        self._routing_key,
-                        message_str,
-                        self._message_properties,
-                        mandatory=True,
-                    )
-                )
+                publish()
             except pika.exceptions.ConnectionWrongStateError:
                 self._log.exception(f"Exception while trying to publish message on attempt {attempt}!")
 
@@ -69,9 +288,6 @@ class Producer(Process):
 
             break
 
-        self._message_number += 1
-        self._log.info(f"Published message #{self._message_number}")
-
     def run(self):
         while not self._stopping:
             try:
@@ -85,36 +301,53 @@ class Producer(Process):
                 self._channel.queue_declare(queue=self._queue, durable=True)
                 self._channel.queue_bind(queue=self._queue, exchange=self._exchange, routing_key=self._routing_key)
                 self._channel.confirm_delivery()
+                self._batch_channel = None
+
+                # publishes scheduled on a previous connection were lost with it, so send them again
+                with self._pending_lock:
+                    pending = list(self._pending.items())
+                for publish_id, (message_str, properties, routing_key) in pending:
+                    self._publish_pending(publish_id, message_str, properties, routing_key)
+
                 # time_limit=None leads to the connection being dropped for inactivity
-                # not sure if this should be while not self._stopping
-                while True:
+                while not self._stopping:
                     self._connection.process_data_events(time_limit=1)
+
+                self._shutdown()
             except:
                 self._log.exception("Producer caught exception:")
+                # don't leave the failed connection open while waiting to reconnect
+                self._close_connection()
 
             if self._stopping or self._reconnect_wait < 0:
                 break
             else:
-                time.sleep(self._reconnect_wait)
+                self._stop_event.wait(self._reconnect_wait)
                 continue
 
-    def stop(self):
-        self._log.info("Stopping producer as instructed...")
-        # probably have to say we're closing so run doesn't try to reopen connection
-        self._stopping = True
-
-        self._connection.add_callback_threadsafe(
-            functools.partial(self._connection.process_data_events, time_limit=1)
-        )
-
-        self._connection.add_callback_threadsafe(
-            self._channel.close
-        )
-        self._connection.add_callback_threadsafe(
-            self._connection.close
-        )
-
         self._log.debug("Stopping producer logger...")
         self._stop_logger()
 
+    def _shutdown(self):
+        try:
+            if self._drain:
+                # publish whatever is still waiting in the callback queue and wait for its confirms
+                while self._pending:
+                    time_left = self._time_left()
+                    if time_left == 0:
+                        break
+                    self._connection.process_data_events(
+                        time_limit=0.01 if time_left is None else min(time_left, 0.01)
+                    )
+        finally:
+            self._close_connection()
+
         self._log.info("Stopped producer as instructed.")
+
+    def stop(self, drain=True, deadline=None):
+        """
+        Ask the producer to stop; join the thread to wait for it. With drain, messages still waiting to be published or confirmed are flushed first, until deadline (a time.monotonic() value) passes.
+        """
+
+        self._log.info("Stopping producer as instructed...")
+        self._request_stop(drain, deadline)
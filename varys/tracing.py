@@ -0,0 +1,76 @@
+import time
+import uuid
+
+
+TRACE_ID_HEADER = "x-varys-trace-id"
+PUBLISHED_AT_HEADER = "x-varys-published-at"
+HOPS_HEADER = "x-varys-hops"
+
+
+def _now_us():
+    return time.time_ns() // 1000
+
+
+class TraceHook:
+    """
+    Receives the timing measurements varys makes when tracing is enabled by passing a trace_hook to Varys.
+
+    Subclass and override the methods of interest to export the measurements, e.g. to OpenTelemetry spans or metrics. Hooks are called from the producer and consumer threads as well as the calling thread, so implementations must be thread-safe and should return quickly. Exceptions raised by a hook are logged and otherwise ignored.
+
+    ...
+
+    Methods
+    -------
+    on_publish(exchange, trace_id, hops)
+        Called when a message stamped with trace headers is handed to the producer for publishing
+    on_deliver(exchange, trace_id, hops, enqueue_to_deliver)
+        Called when a message is delivered to the consumer by RabbitMQ. enqueue_to_deliver is the time in seconds between the message being published and being delivered, which includes time spent queueing on the broker, or None if the message carried no trace headers. It is measured across hosts so is subject to clock skew.
+    on_dequeue(exchange, trace_id, hops, deliver_to_dequeue)
+        Called when a delivered message is handed to the application, e.g. by Varys.receive. deliver_to_dequeue is the time in seconds the message spent buffered inside the consumer.
+    """
+
+    def on_publish(self, exchange, trace_id, hops):
+        pass
+
+    def on_deliver(self, exchange, trace_id, hops, enqueue_to_deliver):
+        pass
+
+    def on_dequeue(self, exchange, trace_id, hops, deliver_to_dequeue):
+        pass
+
+
+def trace_headers(trace_parent=None):
+    """
+    Return the trace headers for a new message. If trace_parent, a received varys_message, carries a trace then the new message continues that trace with the hop count incremented.
+    """
+
+    parent = read_trace_headers(trace_parent.properties) if trace_parent is not None else None
+
+    if parent is not None:
+        trace_id, _, hops = parent
+        hops += 1
+    else:
+        trace_id = uuid.uuid4().hex
+        hops = 0
+
+    return {
+        TRACE_ID_HEADER: trace_id,
+        PUBLISHED_AT_HEADER: _now_us(),
+        HOPS_HEADER: hops,
+    }
+
+
+def read_trace_headers(properties):
+    """
+    Return the (trace_id, published_at, hops) of a message's properties, where published_at is in microseconds since the epoch, or None if the message was not traced.
+    """
+
+    headers = getattr(properties, "headers", None)
+    if not headers or TRACE_ID_HEADER not in headers:
+        return None
+
+    trace_id = headers[TRACE_ID_HEADER]
+    if isinstance(trace_id, bytes):
+        trace_id = trace_id.decode("utf-8")
+
+    return (trace_id, headers.get(PUBLISHED_AT_HEADER), headers.get(HOPS_HEADER, 0))
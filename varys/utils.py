@@ -1,30 +1,159 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import threading
+import queue
+import time
 import sys
 import json
+import os
 
 
 varys_message = namedtuple("varys_message", "basic_deliver properties body")
 
 
+class FanIn:
+    """
+    Tracks which consumers of a Varys instance have messages waiting, so that the next message from any of several exchanges can be received without polling each one in turn.
+
+    Consumers still buffer messages in their own queue, so receiving from a single exchange and acknowledging messages work as before. Exchanges are served in the order their messages became available.
+
+    ...
+
+    Methods
+    -------
+    put(exchange, message_queue, message)
+        Add a message to a consumer's queue and mark the exchange as ready
+    get(exchanges, timeout=None)
+        Return (exchange, message) for the next message available from any of the exchanges, or None if none arrives within timeout seconds
+    ready(exchanges, timeout=None)
+        Return the exchanges which have messages available, waiting up to timeout seconds for at least one
+    """
+
+    def __init__(self):
+        # exchange -> message queue, in the order the exchanges became ready
+        self._ready = OrderedDict()
+        self._condition = threading.Condition()
+
+    def put(self, exchange, message_queue, message):
+        with self._condition:
+            message_queue.put(message)
+            if exchange not in self._ready:
+                self._ready[exchange] = message_queue
+            self._condition.notify_all()
+
+    def _wait(self, deadline):
+        # must be called holding the condition, returns False once the deadline has passed
+        if deadline is None:
+            self._condition.wait()
+            return True
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+
+        self._condition.wait(remaining)
+        return True
+
+    def get(self, exchanges, timeout=None):
+        exchanges = set(exchanges)
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._condition:
+            while True:
+                exchange = self._first_ready(exchanges)
+                if exchange is None:
+                    if not self._wait(deadline):
+                        return None
+                    continue
+
+                message_queue = self._ready.pop(exchange)
+                try:
+                    message = message_queue.get_nowait()
+                except queue.Empty:
+                    # the message was already taken by a receive from this exchange alone
+                    continue
+
+                # go to the back of the line so that one busy exchange can't starve the others
+                if not message_queue.empty():
+                    self._ready[exchange] = message_queue
+
+                return exchange, message
+
+    def _first_ready(self, exchanges):
+        # must be called holding the condition; usually the first ready exchange is one of those requested,
+        # so this stops there rather than going through every ready exchange
+        stale = []
+        first = None
+        for exchange, message_queue in self._ready.items():
+            if message_queue.empty():
+                # its messages were taken by a receive from this exchange alone
+                stale.append(exchange)
+            elif exchange in exchanges:
+                first = exchange
+                break
+
+        for exchange in stale:
+            del self._ready[exchange]
+
+        return first
+
+    def ready(self, exchanges, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._condition:
+            while True:
+                ready = [
+                    exchange
+                    for exchange in exchanges
+                    if exchange in self._ready and not self._ready[exchange].empty()
+                ]
+                if ready or not self._wait(deadline):
+                    return ready
+
+
+class ConfigurationError(Exception):
+    """
+    Raised when the varys configuration JSON cannot be used.
+
+    exit_code is the status command line tools should exit with: 11 for an unreadable or incomplete configuration, 2 for a missing profile.
+    """
+
+    def __init__(self, message, exit_code):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+
+def _cache_key(profile, config_path):
+    try:
+        config_path = os.path.abspath(config_path)
+        stat = os.stat(config_path)
+    except (OSError, TypeError):
+        raise ConfigurationError(
+            "Configuration JSON does not appear to be valid or does not exist", 11
+        )
+
+    # mtime alone can miss a rewrite within the filesystem's timestamp resolution, or a file replaced by a rename
+    return (config_path, stat.st_mtime_ns, stat.st_size, stat.st_ino, profile)
+
+
 class configurator:
     def __init__(self, profile, config_path):
+        self.cache_key = _cache_key(profile, config_path)
+
         try:
             with open(config_path, "rt") as config_fh:
                 config_obj = json.load(config_fh)
-        except:
-            print(
-                "Configuration JSON does not appear to be valid or does not exist",
-                file=sys.stderr,
+        except (OSError, ValueError):
+            raise ConfigurationError(
+                "Configuration JSON does not appear to be valid or does not exist", 11
             )
-            sys.exit(11)
 
-        if config_obj["version"] != "0.1":
+        if config_obj.get("version") != "0.1":
             print(
                 "Version number in the ROZ configuration file does not appear to be current, ensure configuration format is correct if you experience errors",
                 file=sys.stderr,
             )
 
-        profile_dict = config_obj["profiles"].get(profile)
+        profile_dict = config_obj.get("profiles", {}).get(profile)
         if profile_dict:
             try:
                 self.profile = profile
@@ -37,14 +166,39 @@ class configurator:
                 self.ca_certificate = profile_dict.get("ca_certificate", None)
 
             except KeyError:
-                print(
+                raise ConfigurationError(
                     f"Varys configuration JSON does not appear to contain the necessary fields for profile: {profile}",
-                    file=sys.stderr,
+                    11,
                 )
-                sys.exit(11)
         else:
-            print(
+            raise ConfigurationError(
                 f"Varys configuration JSON does not appear to contain the specified profile {profile}",
-                file=sys.stderr,
+                2,
             )
-            sys.exit(2)
+
+
+_configuration_cache = {}
+_configuration_lock = threading.Lock()
+
+
+def load_configuration(profile, config_path):
+    """
+    Return the configurator for a profile, reusing the previously parsed one unless the configuration file has been modified since.
+    """
+
+    cache_key = _cache_key(profile, config_path)
+
+    with _configuration_lock:
+        configuration = _configuration_cache.get(cache_key)
+        if configuration is None:
+            configuration = configurator(profile, config_path)
+
+            # drop profiles parsed from older versions of the same file
+            for stale_key in [
+                key for key in _configuration_cache if key[0] == cache_key[0] and key[-1] == profile
+            ]:
+                del _configuration_cache[stale_key]
+
+            _configuration_cache[configuration.cache_key] = configuration
+
+    return configuration